@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+#    pyplot - python based data plotting tools
+#    created for DESY Zeuthen
+#    Copyright (C) 2012  Adam Lucke  software@louisenhof2.de
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os, json, logging
+from tempfile import mkstemp
+from collections import OrderedDict, namedtuple
+from threading import Lock
+from multiprocessing import Pool
+import numpy as np
+import tables
+from locket import lock_file
+
+log = logging.getLogger('catalog')
+
+version = 1  # format of the catalog file, older catalogs are rebuilt
+
+TableSpecs = namedtuple('TableSpecs', ('title', 'colnames', 'units', 'rows', 'stats'))
+
+
+def catalog_file(cachedir):
+    'name of the catalog file in cachedir'
+    return os.path.join(cachedir, 'catalog.json')
+
+
+def h5_files(d):
+    'sorted names of all HDF5 files below directory d'
+    files = []
+    for p, dd, f in os.walk(d):
+        for ff in f:
+            if ff.lower().endswith('.h5'):
+                files.append(os.path.join(p, ff).replace('\\', '/'))
+    files.sort()
+    return files
+
+
+def _finite(x):
+    return float(x) if np.isfinite(x) else None  # json has no nan or inf
+
+
+def column_stats(table, blocksize = 2 ** 16):
+    '''minimum, maximum and number of NaN of each numerical column of table,
+    as dict column -> {'min', 'max', 'nan'}, min and max are None if there is no valid value'''
+    cols = [c for c in table.colnames if table.coldtypes[c].kind in 'biuf']
+    lo = dict((c, np.nan) for c in cols)
+    hi = dict((c, np.nan) for c in cols)
+    nan = dict((c, 0) for c in cols)
+    for start in xrange(0, table.nrows, blocksize):
+        rows = table.read(start, min(start + blocksize, table.nrows))
+        for c in cols:
+            v = rows[c]
+            if v.dtype.kind == 'f':
+                isnan = np.isnan(v)
+                nan[c] += int(np.count_nonzero(isnan))
+                v = v[~isnan]
+            if v.size:
+                lo[c] = np.fmin(lo[c], v.min())
+                hi[c] = np.fmax(hi[c], v.max())
+    return dict((c, {'min':_finite(lo[c]), 'max':_finite(hi[c]), 'nan':nan[c]}) for c in cols)
+
+
+def scan_file(filename):
+    '''catalog entry of filename: size and mtime of the file and its tables
+    as list of [node, title, colnames, units, rows, stats], rate pyramid levels are skipped'''
+    st = os.stat(filename)
+    entry = {'size':st.st_size, 'mtime':st.st_mtime, 'tables':[]}
+    try:
+        with tables.openFile(filename, 'r') as h5:
+            for n in h5.walkNodes(classname = 'Table'):
+                if hasattr(n.attrs, 'resolution'):
+                    continue  # skip rate pyramid levels
+                entry['tables'].append([n._v_pathname, n._v_title, n.colnames, json.loads(n.attrs.units),
+                                        int(n.nrows), column_stats(n)])
+    except Exception as e:  # listed again once the file changes
+        log.warning('failed scanning %s: %s', filename, e)
+        entry['tables'] = []
+    return entry
+
+
+def _scan(filename):
+    # for the worker processes
+    return filename, scan_file(filename)
+
+
+class Catalog(object):
+    '''catalog of the tables in the HDF5 files below datadir, kept in the json file catalogfile,
+    which is shared by all processes using it, only files whose size or mtime changed
+    since the last update are scanned, in up to jobs processes'''
+
+    def __init__(self, datadir, catalogfile = None):
+        self.datadir = datadir
+        self.catalogfile = catalogfile
+        self.files = {}  # filename -> entry
+        self.loaded = None  # mtime of catalogfile when it was read
+        self.lock = Lock()
+
+
+    def _load(self):
+        # read the catalog file if another process has written it since
+        try:
+            mtime = os.stat(self.catalogfile).st_mtime
+            if mtime == self.loaded:
+                return
+            with open(self.catalogfile) as f:
+                data = json.load(f)
+            if data.get('version') != version:
+                raise ValueError('catalog version {}'.format(data.get('version')))
+            self.files, self.loaded = data['files'], mtime
+        except (IOError, OSError, ValueError, KeyError) as e:
+            log.debug('not using %s: %s', self.catalogfile, e)
+
+
+    def _save(self):
+        d = os.path.dirname(os.path.abspath(self.catalogfile))
+        fd, tmp = mkstemp('.tmp', 'catalog', d)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version':version, 'files':self.files}, f)
+            os.rename(tmp, self.catalogfile)  # atomic, readers never see partial files
+            self.loaded = os.stat(self.catalogfile).st_mtime
+        except:
+            log.exception('failed writing %s', self.catalogfile)
+            os.remove(tmp)
+
+
+    def _changed(self, files):
+        # files whose catalog entry is missing or outdated
+        changed = []
+        for f in files:
+            e = self.files.get(f)
+            try:
+                st = os.stat(f)
+            except OSError:  # removed meanwhile
+                continue
+            if not e or e['size'] != st.st_size or e['mtime'] != st.st_mtime:
+                changed.append(f)
+        return changed
+
+
+    def update(self, jobs = 1):
+        'rescan new and modified files, forget removed ones'
+        with self.lock:
+            files = h5_files(self.datadir)
+            if self.catalogfile:
+                self._load()
+            if not self._changed(files) and set(files) >= set(self.files):
+                return
+
+            if self.catalogfile:
+                with lock_file(self.catalogfile + '.lock'):
+                    self._load()  # maybe updated by another process while waiting for the lock
+                    self._update(files, jobs)
+            else:
+                self._update(files, jobs)
+
+
+    def _update(self, files, jobs):
+        changed = self._changed(files)
+        removed = set(self.files) - set(files)
+        if not changed and not removed:
+            return
+        log.info('scanning %d of %d files in %s', len(changed), len(files), self.datadir)
+        jobs = min(jobs, len(changed))
+        if jobs > 1:
+            pool = Pool(jobs)
+            try:
+                scanned = pool.map(_scan, changed)
+            finally:
+                pool.terminate()
+        else:
+            scanned = map(_scan, changed)
+        for f in removed:
+            del self.files[f]
+        self.files.update(scanned)
+        if self.catalogfile:
+            self._save()
+
+
+    def tables(self, jobs = 1):
+        'update the catalog and return dict table -> TableSpecs, tables are named filename:/path/to/table'
+        self.update(jobs)
+        tabs = OrderedDict()
+        for f in sorted(self.files):
+            for t in self.files[f]['tables']:
+                tabs[f + ':' + t[0]] = TableSpecs(*t[1:])
+        return tabs
+
+
+    def stats(self, filename, node):
+        '''column statistics of table node in filename, None if the file
+        is not in the catalog or has changed since it was scanned'''
+        if self.catalogfile:
+            with self.lock:
+                self._load()
+        e = self.files.get(filename)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        if not e or e['size'] != st.st_size or e['mtime'] != st.st_mtime:
+            return None
+        for t in e['tables']:
+            if t[0] == node:
+                return t[5]
+        return None
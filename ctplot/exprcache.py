@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#    pyplot - python based data plotting tools
+#    created for DESY Zeuthen
+#    Copyright (C) 2012  Adam Lucke  software@louisenhof2.de
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os, json, hashlib, logging
+from tempfile import mkstemp
+import numpy as np
+
+log = logging.getLogger('exprcache')
+
+
+def file_identity(filename):
+    'identity of a file, changes if the file is modified or replaced'
+    st = os.stat(filename)
+    return os.path.abspath(filename), st.st_size, st.st_mtime, st.st_dev, st.st_ino
+
+
+class ExprCache(object):
+    '''disk cache of evaluated expressions, stored as .npy files in cachedir/expr,
+    the least recently used files are removed if the cache grows larger than maxsize bytes'''
+
+    def __init__(self, cachedir, maxsize):
+        self.dir = os.path.join(cachedir, 'expr')
+        self.maxsize = maxsize
+        if not os.path.isdir(self.dir):
+            try:
+                os.makedirs(self.dir)
+            except OSError:  # created by another process meanwhile
+                pass
+
+
+    def key(self, filename, node, settings, expr, cut):
+        'key for expression expr evaluated on table node in filename with cut and window settings'
+        k = json.dumps([file_identity(filename), node, settings, expr, cut])
+        return hashlib.sha1(k).hexdigest()
+
+
+    def _path(self, key):
+        return os.path.join(self.dir, key + '.npy')
+
+
+    def get(self, key):
+        'return the memory mapped array stored under key or None'
+        path = self._path(key)
+        try:
+            a = np.load(path, mmap_mode = 'c')
+            os.utime(path, None)  # mark as recently used
+            return a
+        except (IOError, OSError, ValueError):
+            return None
+
+
+    def put(self, key, a):
+        'store array a under key'
+        a = np.asarray(a)
+        if a.dtype.hasobject:
+            return  # cannot be memory mapped
+        fd, tmp = mkstemp('.tmp', '', self.dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, a)
+            os.rename(tmp, self._path(key))  # atomic, readers never see partial files
+        except:
+            log.exception('failed caching %s', key)
+            os.remove(tmp)
+            return
+        self._evict()
+
+
+    def _evict(self):
+        # remove least recently used files until the cache fits into maxsize
+        files = []
+        for f in os.listdir(self.dir):
+            try:
+                st = os.stat(os.path.join(self.dir, f))
+                files.append((st.st_mtime, st.st_size, f))
+            except OSError:  # removed by another process
+                pass
+        size = sum(f[1] for f in files)
+        for mtime, s, f in sorted(files):
+            if size <= self.maxsize:
+                break
+            log.debug('removing %s from expression cache', f)
+            try:
+                os.remove(os.path.join(self.dir, f))
+            except OSError:
+                pass
+            size -= s
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+#    pyplot - python based data plotting tools
+#    created for DESY Zeuthen
+#    Copyright (C) 2012  Adam Lucke  software@louisenhof2.de
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import ast, re, logging, operator
+import numpy as np
+import numexpr as ne
+from safeeval import safeeval
+
+log = logging.getLogger('expressions')
+
+
+def pycolumn(a):
+    'column array with the dtype of the python values a table row returns (float, int, bool)'
+    if a.dtype.kind == 'f':
+        return a.astype(np.float64, copy = False)
+    if a.dtype.kind in 'iu':
+        return a.astype(np.int64, copy = False)
+    return a
+
+
+def _const(v):
+    # numbers become 1 element arrays, so numpy applies the same type promotion
+    # as for the python scalars of the row path (no value based casting)
+    if isinstance(v, (int, long, float, complex)):
+        return np.array([v])
+    return v
+
+def _num(a):
+    # python does arithmetics on bools as on ints
+    return a.astype(np.int64) if a.dtype == np.bool_ else a
+
+def _and(a, b):
+    if a.dtype != np.bool_ or b.dtype != np.bool_:
+        raise TypeError('and/or on non boolean arrays')
+    return a & b
+
+def _or(a, b):
+    if a.dtype != np.bool_ or b.dtype != np.bool_:
+        raise TypeError('and/or on non boolean arrays')
+    return a | b
+
+_ops = {'+':operator.add, '-':operator.sub, '*':operator.mul, '/':operator.div, '//':operator.floordiv,
+        '%':operator.mod, '**':np.power, '<<':operator.lshift}  # np.power avoids numpy's fast path for array**scalar
+
+def _checked(op, a, b):
+    '''arithmetics op on arrays, raises where python raises (division by zero, fractional power
+    of a negative number, float overflow of **) and where int64 would overflow, so the expression
+    is evaluated row by row and gives python's exception or long integers'''
+    if op in ('/', '//', '%', '**'):
+        with np.errstate(divide = 'raise', invalid = 'raise', over = 'raise' if op == '**' else 'ignore'):
+            r = _ops[op](a, b)
+    else:
+        r = _ops[op](a, b)
+    if r.dtype.kind in 'iu' and op in ('+', '-', '*', '**', '<<'):
+        if op == '<<':
+            if np.any(b < 0):
+                raise ValueError('negative shift count')
+            f = a * np.power(2.0, b)
+        else:
+            f = _ops[op](a.astype(np.float64), b.astype(np.float64))
+        if np.any(np.abs(f) >= 2.0 ** 62):  # may have wrapped around
+            raise OverflowError('int64 overflow')
+    return r
+
+_eval = safeeval()
+_eval.globals.update({'_const':_const, '_num':_num, '_and':_and, '_or':_or, '_checked':_checked,
+                      '_not':np.logical_not, '_tand':np.logical_and, '_tor':np.logical_or})
+
+_binops = {ast.Add:'+', ast.Sub:'-', ast.Mult:'*', ast.Div:'/', ast.Mod:'%', ast.Pow:'**', ast.FloorDiv:'//',
+           ast.BitAnd:'&', ast.BitOr:'|', ast.BitXor:'^', ast.LShift:'<<', ast.RShift:'>>'}
+_unaryops = {ast.USub:'-', ast.UAdd:'+', ast.Invert:'~', ast.Not:'~'}
+_arithmetic = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Mod, ast.Pow, ast.FloorDiv, ast.LShift, ast.RShift,
+               ast.USub, ast.UAdd, ast.Invert)
+_cmpops = {ast.Eq:'==', ast.NotEq:'!=', ast.Lt:'<', ast.LtE:'<=', ast.Gt:'>', ast.GtE:'>='}
+
+# subset that numexpr evaluates exactly like python does on floats,
+# no division, numexpr gives inf or nan where python raises ZeroDivisionError
+_ne_binops = (ast.Add, ast.Sub, ast.Mult, ast.BitAnd, ast.BitOr)
+_ne_functions = ('sqrt', 'abs')
+
+
+def compile_function(x, fields):
+    'compile expression x into a function of a row, map T_a --> row["T_a"], etc.'
+    for v in fields:
+        x = re.sub('(?<!\\w)' + re.escape(v) + '(?!\\w)', 'row["' + v + '"]', x)
+    return _eval('lambda row: ({})'.format(x))
+
+
+def referenced_fields(x, fields):
+    'set of fields used in expression x'
+    return set(v for v in fields if re.search('(?<!\\w)' + re.escape(v) + '(?!\\w)', x))
+
+
+class _Vectorizer(ast.NodeTransformer):
+    '''rewrite an expression into a lambda operating on a dict of column arrays,
+    raises ValueError for constructs that have no elementwise equivalent'''
+
+    def __init__(self, fields, truth):
+        self.fields = fields
+        self.truth = truth  # only the truth value of the expression matters (cuts)
+
+    def call(self, name, *args):
+        return ast.Call(ast.Name(name, ast.Load()), list(args), [], None, None)
+
+    def visit_Expression(self, node):
+        body = self.visit(node.body)
+        args = ast.arguments([ast.Name('_block', ast.Param())], None, None, [])
+        return ast.Expression(ast.Lambda(args, body))
+
+    def visit_Name(self, node):
+        if node.id in self.fields:
+            return ast.Subscript(ast.Name('_block', ast.Load()), ast.Index(ast.Str(node.id)), ast.Load())
+        return self.call('_const', node)
+
+    def visit_Num(self, node):
+        return self.call('_const', node)
+
+    def visit_BinOp(self, node):
+        if type(node.op) not in _binops:
+            raise ValueError('operator not supported')
+        node = self.generic_visit(node)
+        if isinstance(node.op, _arithmetic):
+            node.left, node.right = self.call('_num', node.left), self.call('_num', node.right)
+        op = _binops[type(node.op)]
+        if op in _ops:
+            return self.call('_checked', ast.Str(op), node.left, node.right)
+        return node
+
+    def visit_UnaryOp(self, node):
+        if type(node.op) not in _unaryops:
+            raise ValueError('operator not supported')
+        node = self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return self.call('_not', node.operand)
+        if isinstance(node.op, _arithmetic):
+            node.operand = self.call('_num', node.operand)
+        return node
+
+    def visit_BoolOp(self, node):
+        f = ('_tand' if self.truth else '_and') if isinstance(node.op, ast.And) else ('_tor' if self.truth else '_or')
+        values = map(self.visit, node.values)
+        return reduce(lambda a, b: self.call(f, a, b), values)
+
+    def visit_Compare(self, node):
+        for op in node.ops:
+            if type(op) not in _cmpops:
+                raise ValueError('comparison not supported')
+        operands = map(self.visit, [node.left] + node.comparators)
+        cmps = [ast.Compare(a, [op], [b]) for a, op, b in zip(operands[:-1], node.ops, operands[1:])]
+        return reduce(lambda a, b: self.call('_and', a, b), cmps)
+
+    def visit_Call(self, node):
+        if not isinstance(node.func, ast.Name) or node.func.id in self.fields \
+                or node.keywords or node.starargs or node.kwargs:
+            raise ValueError('call not supported')
+        if not isinstance(_eval.globals.get(node.func.id), np.ufunc):
+            raise ValueError('{} is not an elementwise function'.format(node.func.id))
+        node.args = map(self.visit, node.args)
+        return node
+
+    def generic_visit(self, node):
+        if not isinstance(node, (ast.BinOp, ast.UnaryOp, ast.expr_context, ast.operator, ast.unaryop)):
+            raise ValueError('{} not supported'.format(type(node).__name__))
+        return ast.NodeTransformer.generic_visit(self, node)
+
+
+def _has_field(node, fields):
+    return any(isinstance(n, ast.Name) and n.id in fields for n in ast.walk(node))
+
+
+def _numexpr_string(node, fields, kinds, context = 'any'):
+    '''translate node into a numexpr expression, raise ValueError if not possible,
+    context is 'num' or 'bool' if the parent expects a number or a truth value,
+    kinds is filled with the fields used as numbers (need float64) or as truth values (need bool)'''
+    s = lambda n, c: _numexpr_string(n, fields, kinds, c)
+    number, truth = context != 'bool', context != 'num'
+    if isinstance(node, ast.Name) and node.id in fields:
+        kind = 'numeric' if number else 'logical'
+        if kinds.setdefault(node.id, kind) != kind:
+            raise ValueError('{} used as number and as truth value'.format(node.id))
+        return node.id
+    if isinstance(node, ast.Num) and number:
+        if isinstance(node.n, float) or (isinstance(node.n, (int, long)) and abs(node.n) < 2 ** 53):
+            return repr(node.n).rstrip('L')
+    if isinstance(node, ast.BinOp) and isinstance(node.op, _ne_binops):
+        if not _has_field(node.left, fields) and not _has_field(node.right, fields):
+            raise ValueError('constant arithmetics')
+        c = 'bool' if isinstance(node.op, (ast.BitAnd, ast.BitOr)) else 'num'
+        if (c == 'num' and number) or (c == 'bool' and truth):
+            return '({}{}{})'.format(s(node.left, c), _binops[type(node.op)], s(node.right, c))
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub) and number:
+        return '(-{})'.format(s(node.operand, 'num'))
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not) and truth:
+        return '(~{})'.format(s(node.operand, 'bool'))
+    if isinstance(node, ast.BoolOp) and truth:
+        op = '&' if isinstance(node.op, ast.And) else '|'
+        return '({})'.format(op.join(s(v, 'bool') for v in node.values))
+    if isinstance(node, ast.Compare) and all(type(op) in _cmpops for op in node.ops) \
+            and _has_field(node, fields) and truth:
+        operands = [s(n, 'num') for n in [node.left] + node.comparators]
+        return '({})'.format('&'.join('({}{}{})'.format(a, _cmpops[type(op)], b)
+                                      for a, op, b in zip(operands[:-1], node.ops, operands[1:])))
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _ne_functions \
+            and node.func.id not in fields and len(node.args) == 1 and not node.keywords and number:
+        return '{}({})'.format(node.func.id, s(node.args[0], 'num'))
+    raise ValueError('not supported by numexpr')
+
+
+def _numexpr_dtypes_ok(kinds, dtypes):
+    for k, kind in kinds.iteritems():
+        if dtypes[k] != (np.float64 if kind == 'numeric' else np.bool_):
+            return False
+    return True
+
+
+class _Row(object):
+    'row i of a block, values are python scalars like those of a table row'
+    __slots__ = ('columns', 'i')
+
+    def __init__(self, block, fields, n):
+        self.columns = dict((k, block[k][:n].tolist()) for k in fields)
+        self.i = 0
+
+    def __getitem__(self, k):
+        return self.columns[k][self.i]
+
+
+class Expression(object):
+    '''plot expression, evaluated on blocks of column arrays by numexpr or numpy,
+    or row by row for expressions that cannot be vectorized'''
+
+    def __init__(self, expr, fields, truth = False):
+        self.expr = expr
+        self.truth = truth
+        self.fields = referenced_fields(expr, fields)
+        self.rowfunc = compile_function(expr, fields)
+        self.engines = []  # (name, function of block), first one that works is used
+        self.verified = False
+        self.ne_expr = None
+
+        try:
+            tree = ast.parse(expr.strip(), mode = 'eval')
+        except SyntaxError:
+            tree = None
+
+        if tree is not None:
+            try:
+                self.ne_kinds = {}
+                self.ne_expr = _numexpr_string(tree.body, self.fields, self.ne_kinds, 'bool' if truth else 'any')
+                self.engines.append(('numexpr', self._numexpr))
+            except ValueError:
+                self.ne_expr = None
+            try:
+                code = compile(ast.fix_missing_locations(_Vectorizer(self.fields, truth).visit(tree)), '<expr>', 'eval')
+                self.engines.append(('numpy', _eval(code)))
+            except ValueError:
+                pass
+
+        log.debug('expression %s, fields %s, engines %s', expr, sorted(self.fields), [e[0] for e in self.engines])
+
+
+    def __getstate__(self):
+        # compiled functions cannot be pickled, compile again and keep the engine selection
+        return self.expr, self.fields, self.truth, [name for name, f in self.engines], self.verified
+
+
+    def __setstate__(self, state):
+        expr, fields, truth, engines, verified = state
+        self.__init__(expr, fields, truth)
+        self.engines = [e for e in self.engines if e[0] in engines]
+        self.verified = verified
+
+
+    def __call__(self, row):
+        'evaluate expression for a single row'
+        return self.rowfunc(row)
+
+
+    def _numexpr(self, block):
+        cols = dict((k, block[k]) for k in self.fields)
+        if not _numexpr_dtypes_ok(self.ne_kinds, dict((k, c.dtype) for k, c in cols.iteritems())):
+            raise TypeError('numexpr evaluation requires float64 numbers and bool truth values')
+        return ne.evaluate(self.ne_expr, local_dict = cols)
+
+
+    def condition(self, table):
+        '''return the expression as condition for an in-kernel query on table (Table.where),
+        None if the query would not select exactly the rows the row function selects'''
+        if self.truth and self.ne_expr and _numexpr_dtypes_ok(self.ne_kinds, table.coldtypes):
+            return self.ne_expr
+
+
+    def _result(self, r, n):
+        r = np.asarray(r)
+        if self.truth:
+            r = r.astype(bool)
+        if r.shape != (n,):
+            if r.size != 1:
+                raise ValueError('expression does not evaluate elementwise')
+            r = np.repeat(r.ravel(), n)
+        return r
+
+
+    def _rowvalue(self, row):
+        v = self.rowfunc(row)
+        return bool(v) if self.truth else v
+
+
+    def rows(self, block, n):
+        'evaluate expression row by row on the block, return list'
+        row = _Row(block, self.fields, n)
+        values = []
+        for i in xrange(n):
+            row.i = i
+            values.append(self._rowvalue(row))
+        return values
+
+
+    def block(self, block, n):
+        '''evaluate expression on the block (dict of pycolumn arrays of length n),
+        return array or list if the expression had to be evaluated row by row'''
+        while self.engines:
+            name, f = self.engines[0]
+            try:
+                r = self._result(f(block), n)
+                if not self.verified and n > 0:
+                    # the first row computed by the row function must match exactly
+                    v = np.array([self._rowvalue(_Row(block, self.fields, 1))])
+                    if v.dtype != r.dtype or v.tobytes() != r[:1].tobytes():
+                        raise TypeError('{} result differs from row evaluation'.format(name))
+                    self.verified = True
+                return r
+            except Exception as e:
+                log.debug('%s evaluation of %s failed: %s', name, self.expr, e)
+                self.engines.pop(0)
+        return self.rows(block, n)
+
+
+class Buffer(object):
+    '''typed array the block results of an expression are appended to,
+    preallocated for size elements and grown geometrically if needed'''
+
+    def __init__(self, size = 0):
+        self.size = size
+        self.data = None  # created with the dtype of the first result
+        self.n = 0
+
+
+    def append(self, part):
+        'append block result (array or list from row by row evaluation)'
+        part = np.asarray(part)
+        if not len(part):
+            return  # empty results do not tell the dtype
+        if self.data is None:
+            self.data = np.empty(max(self.size, len(part)), dtype = part.dtype)
+        elif not np.can_cast(part.dtype, self.data.dtype):
+            self.data = self.data.astype(np.promote_types(self.data.dtype, part.dtype))
+        n = self.n + len(part)
+        if n > len(self.data):
+            self.data.resize(max(n, 2 * len(self.data)), refcheck = False)
+        self.data[self.n:n] = part
+        self.n = n
+
+
+    def array(self):
+        'return the appended results as array'
+        if self.data is None:
+            return np.array([])
+        if len(self.data) > self.n:
+            self.data.resize(self.n, refcheck = False)
+        return self.data
@@ -5,6 +5,7 @@ import tables as t
 from progressbar import ProgressBar, Bar, ETA, Percentage
 from collections import OrderedDict
 from utils import set_attrs, seconds2datetime
+from rates import build_pyramid, NotSortedError
 import dateutil.parser as dp
 import sys, json, os
 
@@ -33,7 +34,7 @@ def _printinfo(t):
 
 
 
-def merge(primary_file, secondary_file = None, outfile = None, primary_table = None, secondary_table = None, merge_on = 'time', max_inter = 4 * 3600, quiet = False):
+def merge(primary_file, secondary_file = None, outfile = None, primary_table = None, secondary_table = None, merge_on = 'time', max_inter = 4 * 3600, quiet = False, pyramid = False):
     # open data file(s)
     if outfile is None:
         h5pri = h5out = t.openFile(primary_file, 'r+')
@@ -182,6 +183,13 @@ def merge(primary_file, secondary_file = None, outfile = None, primary_table = N
         print "first merged record", seconds2datetime(t0, merged_table[0][etime])
         print " last merged record", seconds2datetime(t0, merged_table[-1][etime])
 
+        if pyramid:
+            print "building rate pyramid..."
+            try:
+                build_pyramid(merged_table)
+            except NotSortedError as e:
+                print "no rate pyramid,", e
+
 
 
 
@@ -200,6 +208,7 @@ def main():
     parser.add_argument('-f', '--force', action = 'store_true', help = 'overwrite existing file')
 #    parser.add_argument('-a', '--append', action = 'store_true', help = 'append new data to existing file/table')
     parser.add_argument('-q', '--quiet', action = 'store_true', help = 'do not show progressbar, just print error messages')
+    parser.add_argument('-p', '--pyramid', action = 'store_true', help = 'precompute rate pyramid (1min, 10min, 1h, 1d bins) for fast rate plots')
     parser.add_argument('file_1', help = 'HDF5 file with primary table')
     parser.add_argument('table_1', help = 'name of primary table (event table)')
     parser.add_argument('file_2', help = 'HDF5 file with secondary table (may be the same as file_1)')
@@ -217,7 +226,7 @@ def main():
             raise RuntimeError('file \'{}\' already exists'.format(out))
 
     merge(opts.file_1, opts.file_2, outfile = out, primary_table = opts.table_1, secondary_table = opts.table_2,
-          merge_on = opts.merge, max_inter = opts.maxint, quiet = opts.quiet)
+          merge_on = opts.merge, max_inter = opts.maxint, quiet = opts.quiet, pyramid = opts.pyramid)
 
 
 if __name__ == '__main__':
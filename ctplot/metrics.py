@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+#    pyplot - python based data plotting tools
+#    created for DESY Zeuthen
+#    Copyright (C) 2012  Adam Lucke  software@louisenhof2.de
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os, json, errno, logging, random, string, atexit
+from time import time
+from tempfile import mkstemp
+from threading import Lock, Timer
+from contextlib import contextmanager
+from collections import OrderedDict
+from locket import lock_file
+
+log = logging.getLogger('metrics')
+
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)  # seconds
+
+# name: type, help
+definitions = OrderedDict([
+    ('ctplot_stage_seconds', ('histogram', 'time spent in the stages of making a plot')),
+    ('ctplot_request_seconds', ('histogram', 'time to answer a request, by handler')),
+    ('ctplot_rows_scanned_total', ('counter', 'table rows read for plots')),
+    ('ctplot_rows_kept_total', ('counter', 'table rows passing the cuts')),
+    ('ctplot_cache_requests_total', ('counter', 'cache lookups, by cache and result')),
+    ('ctplot_render_queue', ('gauge', 'plots rendering or waiting for a render process')),
+])
+
+_lock = Lock()
+_values = {}  # (name, labels): value, bucket counts + [sum] for histograms
+_pid = None  # process the values belong to
+_file = None  # file of this process in directory
+_dirty = False
+_flushed = 0  # time of the last write of the values of this process
+_timer = None  # writes the values once interval is over
+directory = None  # where the processes store their values, None keeps them in memory
+interval = 5  # seconds between writes of the values of a process
+ended = 'ended.json'  # sum of the counters and histograms of processes that ended
+
+
+def configure(d):
+    '''store the values of this process and the processes started by it in directory d,
+    each in its own json file, so the values of all processes can be summed up'''
+    global directory
+    try:
+        os.makedirs(d)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    directory = d
+
+
+def _key(name, labels):
+    assert name in definitions, name
+    if os.getpid() != _pid:
+        _reset()
+    return name, tuple(sorted(labels.items()))
+
+
+def _reset():
+    # forked processes start from zero, their values are stored in their own file
+    global _pid, _file, _values, _dirty, _flushed, _timer
+    _pid = os.getpid()
+    _file = '{}-{}.json'.format(_pid, ''.join(random.choice(string.ascii_lowercase) for _ in range(8)))
+    _values = {}
+    _dirty = False
+    _flushed = 0
+    _timer = None  # threads do not survive a fork
+
+
+def inc(name, value = 1, **labels):
+    'increase counter name by value'
+    global _dirty
+    with _lock:
+        k = _key(name, labels)
+        _values[k] = _values.get(k, 0) + value
+        _dirty = True
+
+
+def gauge(name, value, **labels):
+    'set gauge name to value'
+    global _dirty
+    with _lock:
+        _values[_key(name, labels)] = value
+        _dirty = True
+
+
+def observe(name, value, **labels):
+    'add value to histogram name'
+    global _dirty
+    with _lock:
+        k = _key(name, labels)
+        h = _values.get(k)
+        if h is None:
+            h = _values[k] = [0] * (len(buckets) + 2)  # count in each bucket, beyond last bucket, sum
+        for i, b in enumerate(buckets):
+            if value <= b:
+                h[i] += 1
+                break
+        else:
+            h[-2] += 1
+        h[-1] += value
+        _dirty = True
+
+
+@contextmanager
+def timed(name, **labels):
+    'observe the time spent in the with block'
+    t = time()
+    try:
+        yield
+    finally:
+        observe(name, time() - t, **labels)
+
+
+def flush(force = False):
+    '''store the values of this process in directory, if they changed,
+    at most every interval seconds unless force is True'''
+    global _dirty, _flushed, _timer
+    if not directory:
+        return
+    with _lock:
+        if not _dirty or os.getpid() != _pid:
+            return
+        wait = _flushed + interval - time()
+        if wait > 0 and not force:
+            if _timer is None:
+                _timer = Timer(wait, flush, (True,))
+                _timer.daemon = True
+                _timer.start()
+            return
+        data = [[n, l, v] for (n, l), v in _values.iteritems()]
+        _dirty, _flushed, _timer = False, time(), None
+    _write(_file, {'pid':_pid, 'values':data})
+
+
+
+@atexit.register
+def _exit():
+    if _timer and os.getpid() == _pid:
+        _timer.cancel()
+        _timer.join()  # daemon threads break at interpreter shutdown
+    flush(True)
+
+
+def _write(name, data):
+    try:
+        fd, tmp = mkstemp('.tmp', '', directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, os.path.join(directory, name))  # atomic, readers never see partial files
+        return True
+    except (IOError, OSError):
+        log.exception('failed storing metrics')
+        return False
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError as e:
+        return e.errno == errno.EPERM
+
+
+def _read(name):
+    try:
+        with open(os.path.join(directory, name)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None  # removed meanwhile
+
+
+def _sum(stored, total = None):
+    # sum up the values of stored, gauges only of running processes
+    total = {} if total is None else total
+    for s in stored:
+        alive = None
+        for n, l, v in s['values']:
+            if n not in definitions:
+                continue
+            if definitions[n][0] == 'gauge':
+                if alive is None:
+                    alive = s['pid'] == os.getpid() or _alive(s['pid'])
+                if not alive:
+                    continue
+            k = n, tuple(tuple(x) for x in l)
+            if isinstance(v, list):
+                total[k] = map(sum, zip(total[k], v)) if k in total else list(v)
+            else:
+                total[k] = total.get(k, 0) + v
+    return total
+
+
+def _fold(files):
+    # add the files of processes that ended to the ended file and remove them,
+    # so the number of files does not grow with every restarted process
+    stored = dict((f, _read(f)) for f in files if f != ended)
+    dead = [f for f, s in stored.iteritems() if s and s['pid'] != os.getpid() and not _alive(s['pid'])]
+    if not dead:
+        return
+    e = _read(ended)
+    total = _sum([e] if e else [])
+    total = _sum([stored[f] for f in dead], total)  # gauges of dead processes are skipped
+    if _write(ended, {'pid':None, 'values':[[n, l, v] for (n, l), v in total.iteritems()]}):
+        for f in dead:
+            os.remove(os.path.join(directory, f))
+
+
+def collect():
+    '''dict (name, labels): value of all processes, counters and histograms are summed up,
+    including those of processes that ended, gauges only of running processes'''
+    stored = []
+    with _lock:
+        if os.getpid() == _pid:
+            stored.append({'pid':_pid, 'values':[[n, l, v] for (n, l), v in _values.iteritems()]})
+    if directory:
+        with lock_file(os.path.join(directory, 'collect.lock')):  # no reader sees a file folded but not yet removed
+            files = [f for f in os.listdir(directory) if f.endswith('.json') and f != _file]
+            _fold(files)
+            files = [f for f in os.listdir(directory) if f.endswith('.json') and f != _file]
+            stored.extend(filter(None, map(_read, files)))
+    return _sum(stored)
+
+
+def _labels(labels, **more):
+    labels = list(labels) + sorted(more.items())
+    if not labels:
+        return ''
+    escape = lambda v: unicode(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+    return '{' + ','.join(u'{}="{}"'.format(k, escape(v)) for k, v in labels) + '}'
+
+
+def _number(v):
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+def exposition():
+    'the values of all processes in the prometheus text format'
+    total = collect()
+    lines = []
+    for name, (kind, help) in definitions.iteritems():
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for (n, labels), v in sorted(total.items()):
+            if n != name:
+                continue
+            if kind == 'histogram':
+                count = 0
+                for b, c in zip(buckets, v):
+                    count += c
+                    lines.append(u'{}_bucket{} {}'.format(name, _labels(labels, le = _number(float(b))), count))
+                count += v[-2]
+                lines.append(u'{}_bucket{} {}'.format(name, _labels(labels, le = '+Inf'), count))
+                lines.append(u'{}_sum{} {}'.format(name, _labels(labels), _number(v[-1])))
+                lines.append(u'{}_count{} {}'.format(name, _labels(labels), count))
+            else:
+                lines.append(u'{}{} {}'.format(name, _labels(labels), _number(v)))
+    return u'\n'.join(lines).encode('utf-8') + '\n'
@@ -1,20 +1,25 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import os, sys, re, json, tables, ticks, time, logging
-from tempfile import gettempdir
-from os import path
-from collections import OrderedDict, namedtuple
+import os, sys, json, tables, ticks, time, logging
+from tempfile import gettempdir, mkstemp
+from collections import OrderedDict
 from itertools import chain
 import numpy as np
 import numpy.ma as ma
 from scipy.optimize import curve_fit
 import matplotlib as mpl
 import matplotlib.pyplot as plt
-from utils import get_args_from, isseq, set_defaults, number_mathformat, number_format, hashargs, noop
+from utils import get_args_from, isseq, set_defaults, number_mathformat, number_format, hashargs, source_record, source_changed
 from itertools import product
 from safeeval import safeeval
+from expressions import Expression, Buffer, pycolumn
+from exprcache import ExprCache
+from rates import window_averages, pyramid_level, pyramid_averages, NotSortedError
+from catalog import Catalog, catalog_file
+import metrics
 from locket import lock_file
+from multiprocessing import Pool
 
 logging.basicConfig(level = logging.ERROR, format = '%(filename)s:%(funcName)s:%(lineno)d:%(message)s')
 
@@ -24,30 +29,53 @@ log = logging.getLogger('plot')
 eval = safeeval()
 
 
-TableSpecs = namedtuple('TableSpecs', ('title', 'colnames', 'units', 'rows'))
+def available_tables(d = os.path.dirname(__file__) + '/data', catalogfile = None, jobs = 1):
+    'dict table -> TableSpecs of all tables below d, from the persistent catalog in catalogfile if given'
+    return Catalog(d, catalogfile).tables(jobs)
 
-def available_tables(d = os.path.dirname(__file__) + '/data'):
-    files = []
-    for p, d, f in os.walk(d):
-        for ff in f:
-            files.append(path.join(p, ff))
-    files = map(lambda f:f.replace('\\', '/'), files)
-    files = filter(lambda f:f.lower().endswith('.h5'), files)
-    files.sort()
 
-    tabs = OrderedDict()
+def _table_blocks(table, columns, cut, start, stop, blocksize):
+    '''read rows start:stop of table in blocks, yield dict of pycolumn arrays of columns,
+    number of rows in the block and the end row of the block, rows not passing cut are dropped'''
+    condition = cut.condition(table) if cut else None
+    if condition:
+        log.debug('in-kernel condition %s', condition)
+    for a in xrange(start, stop, blocksize):
+        b = min(a + blocksize, stop)
+        if condition:  # let PyTables/numexpr select the rows
+            rows = table.readWhere(condition, start = a, stop = b)
+        else:
+            rows = table.read(a, b)
+        block = dict([(c, pycolumn(rows[c])) for c in columns])
+        n = len(rows)
+        if cut and not condition:
+            mask = np.asarray(cut.block(block, n), dtype = bool)
+            if not mask.all():
+                block = dict([(c, v[mask]) for c, v in block.iteritems()])
+                n = int(np.count_nonzero(mask))
+        yield block, n, b
 
-    for f in files:
-        try:
-            h5 = tables.openFile(f, 'r')
-            for n in h5.walkNodes(classname = 'Table'):
-                tab = f + ':' + n._v_pathname
-                tabs[tab] = TableSpecs(n._v_title, n.colnames, json.loads(n.attrs.units), int(n.nrows))
-            h5.close()
-        except:
-            pass
 
-    return tabs
+
+def _engines(exprs):
+    # evaluation state of expressions, same state means same results
+    return [([name for name, f in e.engines], e.verified) for e in exprs]
+
+
+
+def _evaluate(task):
+    'evaluate expressions on a row range of a table, runs in a worker process'
+    i, filename, node, exprs, cut, columns, start, stop, blocksize = task
+    parts = [[] for e in exprs]
+    kept = 0  # rows passing the cut
+    with tables.openFile(filename, 'r') as h5:
+        table = h5.getNode(node)
+        for block, n, b in _table_blocks(table, columns, cut, start, stop, blocksize):
+            for e, p in zip(exprs, parts):
+                p.append(e.block(block, n))
+            kept += n
+    return i, parts, _engines(exprs + [cut] if cut else exprs), kept
+
 
 
 def _get(d, k, default = None):
@@ -98,6 +126,39 @@ def get_density2d(bincontents, xwidths, ywidths):
     return bincontents
 
 
+def get_profile(x, y, edges, percentiles = ()):
+    '''count, mean and std of the y values in the x bins [edges[k], edges[k+1]) and
+    a list with the given percentiles of the y values in each bin, empty bins yield nan'''
+    nb = len(edges) - 1
+    k = np.searchsorted(edges, x, 'right') - 1  # bin of each value
+    inside = (0 <= k) & (k < nb)
+    k, y = k[inside], np.asarray(y, dtype = float)[inside]
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        count = np.bincount(k, minlength = nb)
+        mean = np.bincount(k, y, nb) / count
+        std = np.sqrt(np.bincount(k, (y - mean[k]) ** 2, nb) / count)
+
+    bands = []
+    if percentiles:
+        nans = np.bincount(k, np.isnan(y), nb) > 0
+        y = y[np.lexsort((y, k))]  # sorted by bin and value, bin k starts at first[k]
+        first = (np.cumsum(count) - count)[count > 0]
+        n = count[count > 0]
+        for p in percentiles:
+            pos = (n - 1) * (p / 100.0)  # linear interpolation like np.percentile
+            lo = np.floor(pos).astype(int)
+            hi = np.minimum(lo + 1, n - 1)
+            f = pos - lo
+            q = np.empty(nb)
+            q.fill(np.nan)
+            q[count > 0] = y[first + lo] * (1 - f) + y[first + hi] * f
+            q[nans] = np.nan
+            bands.append(q)
+
+    return count, mean, std, bands
+
+
 def get_step_points(bincontents, binedges):
     assert len(bincontents) + 1 == len(binedges)
     x = np.zeros(2 * len(binedges), dtype = float)
@@ -110,6 +171,106 @@ def get_step_points(bincontents, binedges):
     return x, y
 
 
+class StreamHistogram(object):
+    '''1D or 2D histogram of the x (and y) expression of a plot, filled block by block
+    while the data is read, so the data never has to be in memory as a whole,
+    a number of bins (0 = automatic) as binning needs a first pass to find the data range'''
+
+    def __init__(self, exprs, cut, bins):
+        self.exprs = exprs  # expression for each axis
+        self.cut = cut  # cut expression of the plot or None
+        self.bins = bins  # binning for each axis
+        self.edges = [None if np.isscalar(b) else get_binning(b, None)[0] for b in bins]
+        self.n = 0  # number of entries found in the first pass
+        self.lo = np.array([np.nan] * len(bins))
+        self.hi = np.array([np.nan] * len(bins))
+        self.contents = None
+        self.uflow = [0] * len(bins)
+        self.oflow = [0] * len(bins)
+        self.filled = False
+
+
+    def expressions(self):
+        return self.exprs + [self.cut] if self.cut else self.exprs
+
+
+    def needs_range(self):
+        return any(e is None for e in self.edges)
+
+
+    def _values(self, results):
+        # values for each axis of the block results (dict expression -> result), cut applied
+        values = [np.asarray(results[e]) for e in self.exprs]
+        if self.cut:
+            c = np.asarray(results[self.cut], dtype = bool)
+            values = [v[c] for v in values]
+        return values
+
+
+    def scan(self, results):
+        'first pass, find the data range'
+        values = self._values(results)
+        if len(values[0]):
+            self.n += len(values[0])
+            self.lo = np.fmin(self.lo, [np.nanmin(v) for v in values])
+            self.hi = np.fmax(self.hi, [np.nanmax(v) for v in values])
+
+
+    def set_range(self):
+        'make the binnings from the range found in the first pass'
+        for k, b in enumerate(self.bins):
+            if self.edges[k] is None:
+                self.edges[k] = get_binning(b or int(1 + np.log2(self.n)), np.array([self.lo[k], self.hi[k]]))[0]
+
+
+    def use_stats(self, stats, nrows):
+        '''take the data range from the catalog column statistics stats of a table with nrows rows
+        instead of a first pass, possible if all axes are plain columns and there is no cut'''
+        if self.cut or not all(e.strip() in stats for e in self.exprs):
+            return False
+        self.n = nrows
+        self.lo = np.array([np.nan if stats[e.strip()]['min'] is None else stats[e.strip()]['min'] for e in self.exprs])
+        self.hi = np.array([np.nan if stats[e.strip()]['max'] is None else stats[e.strip()]['max'] for e in self.exprs])
+        self.set_range()
+        return True
+
+
+    def fill(self, results):
+        'accumulate the block results'
+        values = self._values(results)
+        if len(values) == 1:
+            contents, _d = np.histogram(values[0], self.edges[0])
+        else:
+            contents, _d1, _d2 = np.histogram2d(values[0], values[1], self.edges)
+        self.contents = contents if self.contents is None else self.contents + contents
+        for k, v in enumerate(values):
+            self.uflow[k] += np.sum(v < self.edges[k][0])
+            self.oflow[k] += np.sum(self.edges[k][-1] < v)
+
+
+    def finish(self):
+        'all data has been filled in'
+        if self.contents is None:  # no data at all
+            self.fill(dict([(e, []) for e in self.expressions()]))
+        self.filled = True
+
+
+    def state(self):
+        'binnings, contents and under- and overflows of the filled histogram as dict of arrays'
+        d = dict(('edges{}'.format(k), e) for k, e in enumerate(self.edges))
+        d.update(contents = self.contents, uflow = self.uflow, oflow = self.oflow)
+        return d
+
+
+    def restore(self, state):
+        'fill the histogram from a state returned by state(), without reading any data'
+        self.edges = [state['edges{}'.format(k)] for k in range(len(self.bins))]
+        self.contents = state['contents']
+        self.uflow, self.oflow = list(state['uflow']), list(state['oflow'])
+        self.filled = True
+
+
+
 def adjust_limits(xy, data, limits = None, marl = 0.05, maru = 0.05):
     assert xy in ('x', 'y')
     lim = getattr(plt, xy + 'lim')
@@ -132,7 +293,7 @@ def sproduct(a, b):
 
 text_poss = map(np.array, [(1, -1), (-1, -1), (-1, 1), (1, 1), (0.5, -1), (-1, 0.5), (0.5, 1), (1, 0.5)])
 text_algn = [('left', 'top'), ('right', 'top'), ('right', 'bottom'), ('left', 'bottom'), ('center', 'top'), ('right', 'center'), ('center', 'bottom'), ('left', 'center')]
-stats_abrv = {'n':'N', 'u':'uflow', 'o':'oflow', 'm':'mean', 's':'std', 'p':'mode', 'e':'median', 'w':'skew', 'k':'kurtos', 'x':'excess', 'c':'cov'}
+stats_abrv = {'n':'N', 'u':'uflow', 'o':'oflow', 'm':'mean', 's':'std', 'p':'mode', 'e':'median', 'w':'skew', 'k':'kurtos', 'x':'excess', 'c':'cov', 'r':'corr'}
 
 
 
@@ -254,15 +415,49 @@ class Plot(object):
 
 
 
+        # histograms are filled while the data is read, unless their data is needed anyway
+        arrays = set()  # (source, expression) needed as arrays
+        for n, s in enumerate(self.sr):
+            if s and self.m[n] not in ('h1', 'h2'):
+                arrays.update((s, getattr(self, v)[n]) for v in 'xyzc')
+        histograms = {}  # source --> histograms
+        self.__histograms = {}  # plot --> histogram
+        for n, s in enumerate(self.sr):
+            if s and self.m[n] in ('h1', 'h2'):
+                axes = 'x' if self.m[n] == 'h1' else 'xy'
+                exprs = [getattr(self, v)[n] for v in axes]
+                if all(exprs) and not all((s, e) in arrays for e in exprs + [self.c[n]] if e):
+                    h = StreamHistogram(exprs, self.c[n], [self.bins(n, v) for v in axes])
+                    self.__histograms[n] = h
+                    if n in self.__restored:  # filled by a previous rendering
+                        h.restore(self.__restored[n])
+                    else:
+                        histograms.setdefault(s, []).append(h)
+        for n, s in enumerate(self.sr):
+            if s and n not in self.__histograms:
+                arrays.update((s, getattr(self, v)[n]) for v in 'xyzc')
+        for s, exprs in expr_data.iteritems():
+            for e in exprs:
+                if (s, e) not in arrays:
+                    exprs[e] = None  # evaluated for histograms only
+
         # loop over tables and fill data lists in expr_data
+        # process pool for parallel evaluation, started before any file is opened
+        self.__jobs = int(self.config.get('jobs') or 1)
+        self.__pool = Pool(self.__jobs) if self.__jobs > 1 else None
         units = {}
-        self._get_data(expr_data, joined_cuts, units)
+        try:
+            self._get_data(expr_data, joined_cuts, units, histograms)
+        finally:
+            if self.__pool:
+                self.__pool.terminate()
+                self.__pool = None
         log.debug(units)
 
 
         # assing data arrays to x/y/z/c-data fields
         for v in 'xyzc':
-            setattr(self, v + 'data', [(expr_data[self.sr[i]][x] if x and self.sr[i] else None) for i, x in enumerate(getattr(self, v))])
+            setattr(self, v + 'data', [(expr_data[self.sr[i]].get(x) if x and self.sr[i] else None) for i, x in enumerate(getattr(self, v))])
             setattr(self, v + 'unit', [(units[self.sr[i]][x] if x and self.sr[i] else None) for i, x in enumerate(getattr(self, v))])
 
         log.debug('source={}'.format(self.s))
@@ -275,7 +470,13 @@ class Plot(object):
 
 
 
-    def _get_data(self, expr_data, filters, units = {}):
+    def _get_data(self, expr_data, filters, units = {}, histograms = {}):
+        # evaluated expressions are cached if the cache is enabled
+        cache, catalog = None, None
+        if self.config['cachedir']:
+            cache = ExprCache(self.config['cachedir'], float(self.config.get('exprcachesize') or 1024) * 2 ** 20)
+            catalog = Catalog(None, catalog_file(self.config['cachedir']))
+
         # evaluate expressions for each source
         for s, exprs in expr_data.iteritems():
             log.debug('processing source {}'.format(s))
@@ -293,8 +494,6 @@ class Plot(object):
                 shift = float(ss[3]) if ss[3] != 'None' else 1
                 weight = ss[4] if ss[4] != 'None' else None
 
-                progr_factor = 1.0 / table.nrows / len(expr_data)
-
                 table_units = tuple(json.loads(table.attrs.units))
 
                 def unit(var):
@@ -305,27 +504,47 @@ class Plot(object):
 
                 units[s] = dict([(e, unit(e)) for e in exprs.keys()])
 
-
-                def compile_function(x):
-                    fields = set(table.colnames)
-                    fields.add('rate')
-                    fields.add('count')
-                    fields.add('weight')
-                    for v in fields:  # map T_a --> row['T_a'], etc.
-                        x = re.sub('(?<!\\w)' + re.escape(v) + '(?!\\w)',
-                                    'row["' + v + '"]', x)
-                    return eval('lambda row: ({})'.format(x))
-
-
-                # compile the expressions
-                exprs = dict([(compile_function(e), d) for e, d in exprs.iteritems()])
-
-                def average():
+                fields = set(table.colnames)
+                fields.add('rate')
+                fields.add('count')
+                fields.add('weight')
+
+                # compile the expressions and the cut
+                exprs = dict([(Expression(e, fields), d) for e, d in exprs.iteritems()])
+                cut = Expression(filters[s], fields, truth = True) if s in filters else None
+
+                # take evaluated expressions from the cache
+                keys, cached = {}, set()
+                if cache:
+                    for expr in exprs.keys():
+                        keys[expr] = cache.key(ss[0], ss[1], ss[2:], expr.expr, filters.get(s))
+                        data = cache.get(keys[expr])
+                        if data is not None:
+                            log.debug('expression %s read from cache', expr.expr)
+                            expr_data[s][expr.expr] = data
+                            cached.add(expr.expr)
+                        metrics.inc('ctplot_cache_requests_total', cache = 'expr', result = 'miss' if data is None else 'hit')
+
+                # histograms are filled from the blocks, unless all their data is cached
+                hists = [h for h in histograms.get(s, []) if not set(h.expressions()) <= cached]
+                streamed = set(chain.from_iterable(h.expressions() for h in hists))
+                for expr, d in exprs.items():
+                    if expr.expr not in streamed and (expr.expr in cached or d is None):
+                        del exprs[expr]  # not to be evaluated
+                if not exprs:
+                    continue
+
+                def progress_to(f):
+                    # progress of the current pass over the data
+                    self.progress = progr_prev + (npass + f) / passes / len(expr_data)
+
+                def average(exprlist):
                     # look if there is data for this source in the cache
                     cachedir = self.config['cachedir'] or gettempdir()
-                    cachefile = os.path.join(cachedir, 'avg{}.h5'.format(hashargs(s)))
+                    cachefile = os.path.join(cachedir, 'avg{}.h5'.format(hashargs(os.path.realpath(ss[0]), s)))
                     cachefile = os.path.abspath(cachefile)
                     log.debug('cachefile %s', cachefile)
+                    fweight = Expression(weight, fields)
 
 
                     def average_cached():
@@ -333,132 +552,273 @@ class Plot(object):
                             raise  # always fail it cache is disabled
                         with tables.openFile(cachefile) as cacheh5:
                             cachetable = cacheh5.getNode('/data')
-                            progr_factor = 1.0 / cachetable.nrows / len(expr_data)
+                            if source_changed(json.loads(cachetable.attrs.sourcefile)):
+                                log.info('%s changed since averaging', ss[0])
+                                raise IOError('outdated cachefile {}'.format(cachefile))
                             log.info('reading averaged data from cache')
-                            for row in cachetable.iterrows():
-                                self.progress = progr_prev + row.nrow * progr_factor
-                                yield row
+                            metrics.inc('ctplot_cache_requests_total', cache = 'avg', result = 'hit')
+                            for x in evaluate(cachetable, cut, exprlist, cachefile): yield x
+
+
+                    def average_rows(cachetable):
+                        # sequential averaging, needed if the time column is not sorted
+                        cacherow = cachetable.row
+
+                        assert 0 < shift <= 1
+                        it = table.colnames.index('time')  # index of time column
+                        ta = table[0][it]  # window left edge
+                        tb = ta + window  # window right edge
+                        wd = []  # window data
+                        cols = table.colnames
+                        wdlen = len(cols) + 1
+
+                        def append(r):
+                            wd.append(np.fromiter(chain(r[:], [fweight(r)]), dtype = np.float, count = wdlen))
+
+                        for row in table.iterrows():
+                            if row[it] < tb:  # add row if in window
+                                append(row)
+                            else:  # calculate av and shift window
+                                n = len(wd)
+                                if n > 0:
+                                    wdsum = reduce(lambda a, b: a + b, wd)
+                                    for i, c in enumerate(cols):
+                                        cacherow[c] = wdsum[i] / n
+                                    cacherow['time'] = (ta + tb) * 0.5  # overwrite with interval center
+                                    cacherow['count'] = n
+                                    cacherow['weight'] = wdsum[-1] / n
+                                    cacherow['rate'] = n / window
+                                    progress_to(float(row.nrow) / table.nrows)
+                                    cacherow.append()
+
+                                ta += shift * window  # shift window
+                                tb = ta + window
+                                if row[it] >= tb:
+                                    ta = row[it]  # shift window
+                                    tb = ta + window
+
+                                if shift == 1:  # windows must be empty
+                                    wd = []
+                                else:  # remove data outside new window
+                                    wd = filter(lambda x: ta <= x[it] < tb, wd)
+                                append(row)
+
+                        cachetable.flush()
 
 
                     def average_computed():
+                        metrics.inc('ctplot_cache_requests_total', cache = 'avg', result = 'miss')
+                        # written to a temporary file moved into place when complete,
+                        # readers not holding the lock never see a partial cachefile
+                        fd, tmpfile = mkstemp('.tmp', 'avg', os.path.dirname(cachefile))
+                        os.close(fd)
                         try:
                             log.debug('creating averaged data cachefile')
-                            cacheh5 = tables.openFile(cachefile, 'w')
+                            cacheh5 = tables.openFile(tmpfile, 'w')
                         except:
-                            log.exception('failed opening %s', cachefile)
+                            log.exception('failed opening %s', tmpfile)
+                            os.remove(tmpfile)
                             raise RuntimeError('cache for {} in use or corrupt, try again in a few seconds'.format(s))
 
-                        with cacheh5:
-                            # use tables col descriptor and append fields rate and count
-                            log.debug('caching averaged data')
-                            coldesc = OrderedDict()  # keep the order
-                            for k in table.colnames:
-                                d = table.coldescrs[k]
-                                if isinstance(d, tables.BoolCol):  # make bool to float for averaging
-                                    coldesc[k] = tables.FloatCol(pos = len(coldesc))
-                                else:
-                                    coldesc[k] = d
-                            coldesc['count'] = tables.IntCol(pos = len(coldesc))
-                            coldesc['weight'] = tables.FloatCol(pos = len(coldesc))
-                            coldesc['rate'] = tables.FloatCol(pos = len(coldesc))
-                            cachetable = cacheh5.createTable('/', 'data', coldesc, 'cached data')
-                            cachetable.attrs.source = s
-                            cacherow = cachetable.row
-
-                            assert 0 < shift <= 1
-                            it = table.colnames.index('time')  # index of time column
-                            ta = table[0][it]  # window left edge
-                            tb = ta + window  # window right edge
-                            wd = []  # window data
-                            cols = table.colnames
-                            wdlen = len(cols) + 1
-                            fweight = compile_function(weight)
-
-                            def append(r):
-                                wd.append(np.fromiter(chain(r[:], [fweight(r)]), dtype = np.float, count = wdlen))
-
-                            progr_factor = 1.0 / table.nrows / len(expr_data)
-
-                            for row in table.iterrows():
-                                if row[it] < tb:  # add row if in window
-                                    append(row)
-                                else:  # calculate av and shift window
-                                    n = len(wd)
-                                    if n > 0:
-                                        wdsum = reduce(lambda a, b: a + b, wd)
-                                        for i, c in enumerate(cols):
-                                            cacherow[c] = wdsum[i] / n
-                                        cacherow['time'] = (ta + tb) * 0.5  # overwrite with interval center
-                                        cacherow['count'] = n
-                                        cacherow['weight'] = wdsum[-1] / n
-                                        cacherow['rate'] = n / window
-                                        self.progress = progr_prev + row.nrow * progr_factor
-                                        yield cacherow
-                                        cacherow.append()
-
-                                    ta += shift * window  # shift window
-                                    tb = ta + window
-                                    if row[it] >= tb:
-                                        ta = row[it]  # shift window
-                                        tb = ta + window
-
-                                    if shift == 1:  # windows must be empty
-                                        wd = []
-                                    else:  # remove data outside new window
-                                        wd = filter(lambda x: ta <= x[it] < tb, wd)
-                                    append(row)
+                        try:
+                            with cacheh5:
+                                # use tables col descriptor and append fields rate and count
+                                log.debug('caching averaged data')
+                                coldesc = OrderedDict()  # keep the order
+                                for k in table.colnames:
+                                    d = table.coldescrs[k]
+                                    if isinstance(d, tables.BoolCol):  # make bool to float for averaging
+                                        coldesc[k] = tables.FloatCol(pos = len(coldesc))
+                                    else:
+                                        coldesc[k] = d
+                                coldesc['count'] = tables.IntCol(pos = len(coldesc))
+                                coldesc['weight'] = tables.FloatCol(pos = len(coldesc))
+                                coldesc['rate'] = tables.FloatCol(pos = len(coldesc))
+                                cachetable = cacheh5.createTable('/', 'data', coldesc, 'cached data',
+                                                                 filters = self.__cache_filters,
+                                                                 chunkshape = (self.__cache_chunk_rows,))
+                                cachetable.attrs.source = s
+                                cachetable.attrs.sourcefile = json.dumps(source_record(ss[0]))  # to detect changes
+
+                                # use precomputed bins if the weight is constant
+                                level = pyramid_level(table, window, shift) if not fweight.fields else None
+
+                                with metrics.timed('ctplot_stage_seconds', stage = 'average'):
+                                    metrics.inc('ctplot_rows_scanned_total', level.nrows if level else table.nrows)
+                                    try:  # average all windows at once
+                                        if level:
+                                            log.info('averaging %s from rate pyramid level %s', s, level._v_pathname)
+                                            averaged = pyramid_averages(level, window, shift, fweight, cachetable.dtype,
+                                                                        self.__block_size, progress_to)
+                                        else:
+                                            averaged = window_averages(table, window, shift, fweight, cachetable.dtype,
+                                                                       self.__block_size, progress_to)
+                                    except NotSortedError:
+                                        log.warning('time column of %s is not sorted, averaging row by row', s)
+                                        average_rows(cachetable)
+                                    else:
+                                        cachetable.append(averaged)
+                                        cachetable.flush()
+                        except:
+                            os.remove(tmpfile)
+                            raise
 
                         if not self.config['cachedir']:
-                            log.debug('removing averaged data cachefile')
-                            os.remove(cachefile)
+                            try:
+                                with tables.openFile(tmpfile) as cacheh5:
+                                    for x in evaluate(cacheh5.getNode('/data'), cut, exprlist, progress = False): yield x
+                            finally:
+                                log.debug('removing averaged data cachefile')
+                                os.remove(tmpfile)
+                            return
+
+                        os.rename(tmpfile, cachefile)
+                        with tables.openFile(cachefile) as cacheh5:
+                            for x in evaluate(cacheh5.getNode('/data'), cut, exprlist, cachefile, progress = False): yield x
 
 
 
+                    started = False  # once blocks are yielded, falling back to another source would repeat them
                     try:  # try using data from cache
-                        for x in average_cached(): yield x
+                        for x in average_cached():
+                            started = True
+                            yield x
                     except:  # if cache fails
+                        if started:
+                            raise
                         with lock_file(cachefile + '.lock'):
                             try:  # try cache again (maybe it was populated while waiting for the lock)
-                                for x in average_cached(): yield x
+                                for x in average_cached():
+                                    started = True
+                                    yield x
                             except:  # if it fails again, compute the data
+                                if started:
+                                    raise
                                 for x in average_computed(): yield x
 
 
 
-                def prefilter(data, filterexpr):
-                    filterexpr = compile_function(filterexpr)
-                    for row in data:
-                        if filterexpr(row):
-                            yield row
+                def evaluate(table, filterexpr, exprlist, filename = None, progress = True):
+                    # evaluate expressions on table in blocks, yield list of block results for each expression,
+                    # if filename is given, the table may be read by the worker processes too
+                    # columns used by expressions and cut, only these are decoded
+                    cols = set(chain.from_iterable(e.fields for e in exprlist + [filterexpr] if e)) & set(table.colnames)
+                    log.debug('          columns {}'.format(sorted(cols)))
+                    nrows = table.nrows
+                    checked = exprlist + [filterexpr] if filterexpr else exprlist
+                    selecting = exprlist if filterexpr is None or filterexpr.condition(table) else checked
+                    bs = self.__block_size
+
+                    def update(stop):
+                        if progress:
+                            progress_to(float(stop) / nrows)
+
+                    metrics.inc('ctplot_rows_scanned_total', nrows)
+
+                    # start in this process until the evaluation engines of all expressions are selected
+                    stop = 0
+                    for block, n, stop in _table_blocks(table, cols, filterexpr, 0, nrows, bs):
+                        metrics.inc('ctplot_rows_kept_total', n)
+                        yield [[e.block(block, n)] for e in exprlist]
+                        update(stop)
+                        if self.__pool and filename and all(e.verified or not e.engines for e in selecting):
+                            break
+
+                    if stop >= nrows:
+                        return
+
+                    # evaluate the remaining row ranges in the worker processes
+                    nblocks = (nrows - stop + bs - 1) // bs
+                    step = bs * -(-nblocks // min(nblocks, 4 * self.__jobs))
+                    ranges = [(a, min(a + step, nrows)) for a in xrange(stop, nrows, step)]
+                    tasks = [(i, filename, table._v_pathname, exprlist, filterexpr, cols, a, b, bs)
+                             for i, (a, b) in enumerate(ranges)]
+                    log.debug('evaluating %d row ranges in %d processes', len(ranges), self.__jobs)
+                    state = _engines(checked)
+                    done, results, k = stop, {}, 0
+                    for i, parts, engines, kept in self.__pool.imap_unordered(_evaluate, tasks):
+                        results[i] = parts, engines, kept
+                        done += ranges[i][1] - ranges[i][0]
+                        update(done)
+                        while k in results and results[k][1] == state:  # yield in row order
+                            parts, engines, kept = results.pop(k)
+                            metrics.inc('ctplot_rows_kept_total', kept)
+                            yield parts
+                            k += 1
+                        if k in results:  # the engines changed in this range
+                            break
+
+                    if k < len(ranges):  # continue in this process to get identical results
+                        log.debug('evaluation engines changed, evaluating rows %d to %d serially', ranges[k][0], nrows)
+                        for block, n, stop in _table_blocks(table, cols, filterexpr, ranges[k][0], nrows, bs):
+                            metrics.inc('ctplot_rows_kept_total', n)
+                            yield [[e.block(block, n)] for e in exprlist]
+                            update(stop)
+
+
+                def collect(exprlist, consume):
+                    # evaluate the expressions, call consume with the results of each block
+                    # as dict expression --> result
+                    if window:  # read averaged data, progress update is done inside average()
+                        tableparts = average(exprlist)
+                    else:
+                        tableparts = evaluate(table, cut, exprlist, ss[0])
+                    for parts in tableparts:
+                        for results in zip(*parts):
+                            consume(dict(zip([e.expr for e in exprlist], results)))
+
+                exprlist = exprs.keys()
+                ranging = [h for h in hists if h.needs_range()]
+                if ranging and catalog and not window:  # data range of plain columns from the table catalog
+                    stats = catalog.stats(ss[0], ss[1])
+                    if stats:
+                        ranging = [h for h in ranging if not h.use_stats(stats, table.nrows)]
+                passes, npass = 2 if ranging else 1, 0
+
+                if ranging:  # first pass to find the data range of histograms with automatic binning
+                    def scan(results):
+                        for h in ranging:
+                            h.scan(results)
+                    needed = set(chain.from_iterable(h.expressions() for h in ranging))
+                    collect([e for e in exprlist if e.expr in needed], scan)
+                    for h in ranging:
+                        h.set_range()
+                    npass = 1
+
+                # buffers for expressions needed as arrays
+                size = 0 if cut or window else table.nrows
+                buffers = dict([(e.expr, Buffer(size)) for e in exprlist
+                                if exprs[e] is not None and e.expr not in cached])
+
+                def fill(results):
+                    for e, b in buffers.iteritems():
+                        b.append(results[e])
+                    for h in hists:
+                        h.fill(results)
+
+                collect(exprlist, fill)
+
+                for h in hists:
+                    h.finish()
 
-
-                def updateProgress(row, fac):
-                    self.progress = progr_prev + row.nrow * fac
-
-                if window:
-                    tableiter = average()
-                    updateProgress = noop  # progress update is done inside average()
-                else:
-                    tableiter = table.iterrows()
-
-                if s in filters:
-                    tableiter = prefilter(tableiter, filters[s])
-
-                for row in tableiter:
-                    for expr, data in exprs.iteritems():
-                        data.append(expr(row))
-                    if row.nrow % 10000 == 0: updateProgress(row, progr_factor)
-
-                # convert data lists to numpy arrays
                 d = expr_data[s]
-                for k in d.keys():
-                    d[k] = np.array(d[k])
+                for expr in exprlist:
+                    if expr.expr in buffers:
+                        d[expr.expr] = buffers[expr.expr].array()
+                        if cache:
+                            cache.put(keys[expr], d[expr.expr])
 
         # done with getting data
         self.progress = 1
 
 
     __tick_density = 1.5
+    __block_size = 2 ** 16  # rows read and evaluated at once
+    __pool = None  # worker processes evaluating row ranges
+    __histograms = {}  # histograms filled while reading the data
+    __restored = {}  # plot --> state of histograms filled by a previous rendering
+    __cache_chunk_rows = 2 ** 12  # chunk size of averaged data cache tables
+    __cache_filters = tables.Filters(complevel = 1, complib = 'zlib')
 
 
     def _configure_pre(self):
@@ -594,24 +954,26 @@ class Plot(object):
 
 
     def plot(self):
-        self._prepare_data()
-        self._configure_pre()
-        for i, m in enumerate(self.m):
-            if m and self.s[i]:
-                self.selectAxes(i)
-                if m == 'xy':
-                    self._xy(i)
-                elif m == 'h1':
-                    self._hist1d(i)
-                elif m == 'h2':
-                    self._hist2d(i)
-                elif m == 'p':
-                    self._profile(i)
-                elif m == 'map':
-                    self._map(i)
-                else:
-                    raise RuntimeError('unknow mode ' + m)
-        self._configure_post()
+        with metrics.timed('ctplot_stage_seconds', stage = 'data'):
+            self._prepare_data()
+        with metrics.timed('ctplot_stage_seconds', stage = 'draw'):
+            self._configure_pre()
+            for i, m in enumerate(self.m):
+                if m and self.s[i]:
+                    self.selectAxes(i)
+                    if m == 'xy':
+                        self._xy(i)
+                    elif m == 'h1':
+                        self._hist1d(i)
+                    elif m == 'h2':
+                        self._hist2d(i)
+                    elif m == 'p':
+                        self._profile(i)
+                    elif m == 'map':
+                        self._map(i)
+                    else:
+                        raise RuntimeError('unknow mode ' + m)
+            self._configure_post()
 
 
     def show(self):
@@ -629,12 +991,36 @@ class Plot(object):
         for ext in extensions:
             n = name + '.' + ext
             log.debug('saving plot to %n', n)
-            plt.savefig(n, bbox_inches = 'tight', pad_inches = 0.5 if 'map' in self.m else 0.1, transparent = False)
+            with metrics.timed('ctplot_stage_seconds', stage = 'savefig', format = ext):
+                plt.savefig(n, bbox_inches = 'tight', pad_inches = 0.5 if 'map' in self.m else 0.1, transparent = False)
             names.append(n)
 
         return dict(zip(extensions, names))
 
 
+    def save_histograms(self, filename):
+        '''store the histograms filled while reading the data in the npz file filename,
+        return False if there are none'''
+        d = {}
+        for n, h in self.__histograms.iteritems():
+            if h.filled:
+                d.update(('{}_{}'.format(n, k), v) for k, v in h.state().iteritems())
+        if not d:
+            return False
+        with open(filename, 'wb') as f:
+            np.savez(f, **d)
+        return True
+
+
+    def load_histograms(self, filename):
+        'fill the histograms from the npz file written by save_histograms instead of reading their data'
+        self.__restored = {}
+        with np.load(filename) as d:
+            for k in d.files:
+                n, key = k.split('_', 1)
+                self.__restored.setdefault(int(n), {})[key] = d[k]
+
+
     __twin = {'x':plt.twiny, 'y':plt.twinx}
 
     def selectAxes(self, i):
@@ -741,25 +1127,35 @@ class Plot(object):
         self.plotted_lines = []
         log.debug('1D histogram of {}'.format([getattr(self, v)[i] for v in 'sxyzc']))
         kwargs = self.opts(i)
-        x, y, z = self.data(i)
 
         o = get_args_from(kwargs, density = False, cumulative = 0)
         o.update(get_args_from(kwargs, style = 'histline' if o.density else 'hist'))
         err = 0  # o.style.startswith('s')
         o.update(get_args_from(kwargs, xerr = err, yerr = err, capsize = 3 if err else 0))
 
-        bins = self.bins(i, 'x')
-        if  bins == 0:
-            bins = int(1 + np.log2(len(x)))
-        binedges, bincenters, binwidths = get_binning(bins, x)
+        h = self.__histograms.get(i)
+        if h and h.filled:  # filled while reading the data
+            binedges = h.edges[0]
+            bincenters = (binedges[1:] + binedges[:-1]) / 2
+            binwidths = np.diff(binedges)
+            bincontents = h.contents
+            uflow, oflow = h.uflow[0], h.oflow[0]
+        else:
+            x, y, z = self.data(i)
+            bins = self.bins(i, 'x')
+            if  bins == 0:
+                bins = int(1 + np.log2(len(x)))
+            binedges, bincenters, binwidths = get_binning(bins, x)
+
+            bincontents, _d1 = np.histogram(x, binedges)
+            assert np.all(binedges == _d1)
+            uflow, oflow = np.sum(x < binedges[0]), np.sum(binedges[-1] < x)
 
-        bincontents, _d1 = np.histogram(x, binedges)
-        assert np.all(binedges == _d1)
         binerrors = np.sqrt(bincontents)
         binerrors[binerrors == 0] = 1
 
         # statsbox
-        self.stats_fields1d(i, x, bincontents, binerrors, binedges)
+        self.stats_fields1d(i, bincontents, binerrors, binedges, uflow, oflow)
 
         if o.density:
             bincontents, binerrors = get_density(bincontents, binerrors, binwidths)
@@ -803,29 +1199,40 @@ class Plot(object):
     def _hist2d(self, i):
         log.debug('2D histogram of {}'.format([getattr(self, v)[i] for v in 'sxyzc']))
         kwargs = self.opts(i)
-        x, y, z = self.data(i)
         o = get_args_from(kwargs, style = 'color', density = False, log = False, cbfrac = 0.04, cblabel = 'bincontent', levels = 10)
         filled = 'color' in o.style or ('fill' in o.style)
         o.update(get_args_from(kwargs, hidezero = o.log or filled, colorbar = filled, clabels = not filled))
 
-        # make binnings
-        bins = self.bins(i, 'x')
-        if  bins == 0:
-            bins = int(1 + np.log2(len(x)))
-        xedges, xcenters, xwidths = get_binning(bins, x)
-
-        bins = self.bins(i, 'y')
-        if  bins == 0:
-            bins = int(1 + np.log2(len(y)))
-        yedges, ycenters, ywidths = get_binning(bins, y)
-
-        bincontents, _d1, _d2 = np.histogram2d(x, y, [xedges, yedges])
-        bincontents = np.transpose(bincontents)
-        assert np.all(_d1 == xedges)
-        assert np.all(_d2 == yedges)
+        h = self.__histograms.get(i)
+        if h and h.filled:  # filled while reading the data
+            xedges, yedges = h.edges
+            xcenters, ycenters = (xedges[1:] + xedges[:-1]) / 2, (yedges[1:] + yedges[:-1]) / 2
+            xwidths, ywidths = np.diff(xedges), np.diff(yedges)
+            bincontents = np.transpose(h.contents)
+            uflow, oflow = h.uflow, h.oflow
+        else:
+            x, y, z = self.data(i)
+
+            # make binnings
+            bins = self.bins(i, 'x')
+            if  bins == 0:
+                bins = int(1 + np.log2(len(x)))
+            xedges, xcenters, xwidths = get_binning(bins, x)
+
+            bins = self.bins(i, 'y')
+            if  bins == 0:
+                bins = int(1 + np.log2(len(y)))
+            yedges, ycenters, ywidths = get_binning(bins, y)
+
+            bincontents, _d1, _d2 = np.histogram2d(x, y, [xedges, yedges])
+            bincontents = np.transpose(bincontents)
+            assert np.all(_d1 == xedges)
+            assert np.all(_d2 == yedges)
+            uflow = [np.sum(x < xedges[0]), np.sum(y < yedges[0])]
+            oflow = [np.sum(xedges[-1] < x), np.sum(yedges[-1] < y)]
 
         # statsbox
-        self.stats_fields2d(i, bincontents, xcenters, ycenters)
+        self.stats_fields2d(i, bincontents, xcenters, ycenters, uflow, oflow)
 
         if o.density:
             bincontents = get_density2d(bincontents, xwidths, ywidths)
@@ -884,26 +1291,27 @@ class Plot(object):
         log.debug('profile of {}'.format([getattr(self, v)[i] for v in 'sxyzc']))
         kwargs = self.opts(i)
         x, y, z = self.data(i)
-        o = get_args_from(kwargs, xerr = 0, yerr = 0)
+        o = get_args_from(kwargs, xerr = 0, yerr = 0, median = 0, band = None)
 
         # make x binning
         xedges, xcenters, xwidths = get_binning(self.bins(i, 'x'), x)
 
-        # compute avg and std for each x bin
+        # compute avg and std (and the median and band percentiles) for each x bin
+        percentiles = ([50] if o.median else []) + (list(np.atleast_1d(o.band)) if o.band else [])
+        count, yy, yerr, bands = get_profile(x, y, xedges, percentiles)
         xx = xcenters
         xerr = 0.5 * xwidths if o.xerr else None
-        yy = []
-        yerr = []
-        for l, u in zip(xedges[:-1], xedges[1:]):
-            bindata = y[(l <= x) & (x < u)]
-            yy.append(np.mean(bindata))
-            yerr.append(np.std(bindata))
         if not o.yerr:
             yerr = None
 
         pargs = set_defaults(kwargs, capsize = 3, marker = '.', linestyle = 'none')
         l, _d, _d = plt.errorbar(xx, yy, yerr, xerr, **pargs)
 
+        if o.median:
+            plt.plot(xx, bands.pop(0), color = l.get_color(), linestyle = '--')
+        if o.band:  # shade between lowest and highest percentile
+            plt.fill_between(xx, bands[0], bands[-1], color = l.get_color(), alpha = 0.25, linewidth = 0)
+
         self.legend.append((l, self.llabel(i)))
 
         self.fit(i, xx, yy, yerr)
@@ -937,14 +1345,14 @@ class Plot(object):
         self.legend.append((l, self.llabel(i)))
 
 
-    def stats_fields1d(self, i, data, contents, errors, edges):
+    def stats_fields1d(self, i, contents, errors, edges, uflow, oflow):
         centers = (edges[1:] + edges[:-1]) / 2
         widths = np.diff(edges)
 
         stats = {}
         stats['N'] = N = np.sum(contents)
-        stats['uflow'] = np.sum(data < edges[0])
-        stats['oflow'] = np.sum(edges[-1] < data)
+        stats['uflow'] = uflow
+        stats['oflow'] = oflow
         stats['mean'] = mean = np.sum(centers * contents) / N
         stats['std'] = std = np.sqrt(np.sum((centers - mean) ** 2 * contents) / N)
         stats['mode'] = centers[np.argmax(contents)]
@@ -962,32 +1370,41 @@ class Plot(object):
         text = '{:6} {}'.format('hist', self.llabel(i))
         sb = self.sb[i]
         if 'a' in sb: sb = 'nmscpewx'
-        if 'uflow' in stats and stats['uflow']: sb += 'u'
-        if 'oflow' in stats and stats['oflow']: sb += 'o'
+        if 'uflow' in stats and stats['uflow'] and 'u' not in sb: sb += 'u'
+        if 'oflow' in stats and stats['oflow'] and 'o' not in sb: sb += 'o'
         for k in sb:
             k = stats_abrv[k]
             if k in stats:
                 text += '\n{:6} {}'.format(k, number_format(stats[k]))
         self.textboxes.append(text)
 
-    def stats_fields2d(self, i, contents, xcenters, ycenters):
+    def stats_fields2d(self, i, contents, xcenters, ycenters, uflow, oflow):
+        # contents[l, k] is the bin at xcenters[k], ycenters[l]
+        xcontents, ycontents = contents.sum(axis = 0), contents.sum(axis = 1)
         stats = {}
         stats['N'] = N = contents.sum()
-        stats['mean'] = mean = np.array([ (contents.sum(axis = 0) * xcenters).sum(),
-                         (contents.sum(axis = 1) * ycenters).sum()]) / N
-        stats['std'] = np.sqrt(np.array([(contents.sum(axis = 0) * (xcenters - mean[0]) ** 2).sum(),
-                                  (contents.sum(axis = 1) * (ycenters - mean[1]) ** 2).sum()]) / N)
-        cov = 0
-        for k, l in product(xrange(contents.shape[1]), xrange(contents.shape[0])):
-            cov += contents[l, k] * (xcenters[k] - mean[0]) * (ycenters[l] - mean[1])
-        stats['cov'] = cov / N
+        stats['uflow'] = np.array(uflow)
+        stats['oflow'] = np.array(oflow)
+        stats['mean'] = mean = np.array([np.dot(xcontents, xcenters), np.dot(ycontents, ycenters)]) / N
+        dx, dy = xcenters - mean[0], ycenters - mean[1]
+        stats['std'] = std = np.sqrt(np.array([np.dot(xcontents, dx ** 2), np.dot(ycontents, dy ** 2)]) / N)
+        stats['cov'] = cov = np.dot(dy, np.dot(contents, dx)) / N
+        stats['corr'] = cov / (std[0] * std[1])
+        median = []
+        for centers, c in ((xcenters, xcontents), (ycenters, ycontents)):  # like stats_fields1d
+            median_i = np.minimum(len(centers) - 1, np.searchsorted(np.cumsum(c) / N, 0.5, side = 'right'))
+            m = centers[median_i]
+            if len(centers) % 2 == 0:
+                m = (m + centers[median_i - 1]) / 2
+            median.append(m)
+        stats['median'] = np.array(median)
         log.debug(stats)
 
         text = '{:6} {}'.format('hist', self.llabel(i))
         sb = self.sb[i]
-        if 'a' in sb: sb = 'nmscpewx'
-        if 'uflow' in stats and stats['uflow']: sb += 'u'
-        if 'oflow' in stats and stats['oflow']: sb += 'o'
+        if 'a' in sb: sb = 'nmscre'
+        if np.any(stats['uflow']) and 'u' not in sb: sb += 'u'
+        if np.any(stats['oflow']) and 'o' not in sb: sb += 'o'
         for k in sb:
             k = stats_abrv[k]
             if k in stats:
@@ -1075,6 +1492,7 @@ def main():
     parser.add_argument('-v', '--verbose', action = 'store_true', help = 'set logging level to DEBUG')
     parser.add_argument('-q', '--quiet', action = 'store_true', help = 'set logging level to ERROR')
     parser.add_argument('-c', '--cache', metavar = 'dir', help = 'dir where to store cached HDF5 tables, cache is deactivated if not set')
+    parser.add_argument('-j', '--jobs', metavar = 'n', type = int, default = 1, help = 'number of processes evaluating the data (default: 1)')
     parser.add_argument('settings', metavar = 'K=V', nargs = '+', type = key_value_pair, help = 'plot settings, given as key value pairs')
 
     settings = {"t":"", "w":"", "h":"", "experiment0":"neutron-mon-neumayer",
@@ -1108,7 +1526,7 @@ def main():
     log.debug(args)
 
 
-    config = {'cachedir':''}
+    config = {'cachedir':'', 'jobs':args.jobs}
     if args.cache:
         config['cachedir'] = args.cache
 
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+#    pyplot - python based data plotting tools
+#    created for DESY Zeuthen
+#    Copyright (C) 2012  Adam Lucke  software@louisenhof2.de
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+import numpy as np
+import tables
+from collections import OrderedDict
+from expressions import pycolumn
+from utils import noop
+
+log = logging.getLogger('rates')
+
+levels = (60, 600, 3600, 86400)  # resolutions of the rate pyramid in seconds
+
+
+class NotSortedError(ValueError):
+    pass
+
+
+def is_sorted(t):
+    return bool(np.all(t[1:] >= t[:-1]))
+
+
+def windows(t, window, shift):
+    '''
+    compute the averaging windows over the sorted time column t,
+    return left edges, right edges, index of the first and index after the last row in each window
+
+    the windows are the ones of the sequential algorithm: start at t[0], slide by
+    shift*window each time a row beyond the window is reached (restart at that row
+    if it is beyond the next window too), the last window is incomplete and dropped
+    '''
+    assert 0 < shift <= 1
+    N = len(t)
+    step = shift * window
+    ta, tb, ia, ib = [], [], [], []
+    a = t[0]  # left edge of the first window of the current run
+    k = 16  # number of windows to try at once
+    while True:
+        # left edges, accumulated like a += step
+        lefts = np.cumsum(np.concatenate([[a], np.repeat(step, k)]))
+        rights = lefts + window
+        trigger = np.searchsorted(t, rights)  # first row beyond each window
+        m = np.count_nonzero(trigger[:-1] < N)  # windows that are closed by a row
+        jump = t[trigger[:m]] >= rights[1:m + 1]  # row is beyond the next window too
+        j = np.flatnonzero(jump)
+        m = j[0] + 1 if len(j) else m
+
+        ta.append(lefts[:m])
+        tb.append(rights[:m])
+        ib.append(trigger[:m])
+
+        if len(j):  # restart at trigger row
+            a = t[trigger[m - 1]]
+            k = 16
+        elif m == k:  # continue the run
+            a = lefts[k]
+            k = min(2 * k, 2 ** 20)
+        else:  # reached end of data
+            break
+
+    ta, tb, ib = np.concatenate(ta), np.concatenate(tb), np.concatenate(ib)
+    ia = np.searchsorted(t, ta)
+    return ta, tb, ia, ib
+
+
+def _window_sums(table, ia, ib, ncols, values, blocksize, progress):
+    # sum the values of rows ia[i]:ib[i] of table for each window i, values(rows, n) gives a (n, ncols) array
+    sums = np.zeros((len(ia), ncols))
+
+    for start in xrange(0, table.nrows, blocksize):
+        stop = min(start + blocksize, table.nrows)
+        n = stop - start
+        data = np.zeros((n + 1, ncols))  # extra row of zeros for reduceat
+        data[:n] = values(table.read(start, stop), n)
+
+        # windows overlapping this block and the part of them inside it
+        ja = np.searchsorted(ib, start, 'right')
+        jb = np.searchsorted(ia, stop, 'left')
+        if ja < jb:
+            idx = np.empty(2 * (jb - ja), dtype = np.intp)
+            idx[::2] = np.clip(ia[ja:jb], start, stop) - start
+            idx[1::2] = np.clip(ib[ja:jb], start, stop) - start
+            sums[ja:jb] += np.add.reduceat(data, idx, axis = 0)[::2]
+
+        progress(float(stop) / table.nrows)
+
+    return sums
+
+
+def window_averages(table, window, shift, weight, dtype, blocksize = 2 ** 16, progress = noop):
+    '''
+    average all columns of table and the weight expression over the windows,
+    return array of dtype with the table's columns (time is set to the window center),
+    count, weight and rate, progress is called with the fraction of rows processed
+    '''
+    t = pycolumn(table.col('time'))
+    if not is_sorted(t):
+        raise NotSortedError('time column is not sorted')
+
+    ta, tb, ia, ib = windows(t, window, shift)
+    cols = table.colnames
+
+    def values(rows, n):
+        block = dict([(c, pycolumn(rows[c])) for c in cols])
+        data = np.empty((n, len(cols) + 1))
+        for i, c in enumerate(cols):
+            data[:, i] = block[c]
+        data[:, -1] = np.asarray(weight.block(block, n), dtype = np.float64)
+        return data
+
+    sums = _window_sums(table, ia, ib, len(cols) + 1, values, blocksize, progress)
+
+    count = ib - ia
+    averaged = np.empty(len(ta), dtype = dtype)
+    for i, c in enumerate(cols):
+        averaged[c] = sums[:, i] / count
+    averaged['time'] = (ta + tb) * 0.5  # interval center
+    averaged['count'] = count
+    averaged['weight'] = sums[:, -1] / count
+    averaged['rate'] = count / window
+    return averaged
+
+
+def _rebin(src, dst, res, counted, blocksize):
+    # sum rows of src into bins of res seconds and append them to dst,
+    # src is a raw table or a finer pyramid level if counted is True
+    cols = [c for c in dst.colnames if c not in ('time', 'count')]
+    carry = None  # last bin of previous block, may continue in the next one
+
+    for start in xrange(0, src.nrows, blocksize):
+        stop = min(start + blocksize, src.nrows)
+        rows = src.read(start, stop)
+        k = np.floor(pycolumn(rows['time']) / res)  # bin number
+        if not is_sorted(k) or carry is not None and k[0] < carry['time'][0] / res:
+            raise NotSortedError('time column of {} is not sorted'.format(src._v_pathname))
+
+        idx = np.concatenate([[0], np.flatnonzero(np.diff(k)) + 1])  # first row of each bin
+        bins = np.empty(len(idx), dtype = dst.dtype)
+        bins['time'] = k[idx] * res
+        if counted:
+            bins['count'] = np.add.reduceat(rows['count'], idx)
+        else:
+            bins['count'] = np.diff(np.concatenate([idx, [len(k)]]))
+        for c in cols:
+            bins[c] = np.add.reduceat(rows[c].astype(np.float64), idx)
+
+        if carry is not None:
+            if carry['time'][0] == bins['time'][0]:  # merge with first bin
+                for c in ['count'] + cols:
+                    bins[c][0] += carry[c][0]
+            else:
+                dst.append(carry)
+        dst.append(bins[:-1])
+        carry = bins[-1:]
+
+    if carry is not None:
+        dst.append(carry)
+    dst.flush()
+
+
+def build_pyramid(table, blocksize = 2 ** 16):
+    '''
+    precompute counts and column sums of table in time bins of all pyramid levels,
+    stored as tables r60, r600, ... in the group <table>_pyramid beside table,
+    each level is built from the next finer one
+    '''
+    h5 = table._v_file
+    parent = table._v_parent
+    name = table._v_name + '_pyramid'
+    if name in parent:
+        h5.removeNode(parent, name, recursive = True)
+    group = h5.createGroup(parent, name, 'rate pyramid of ' + table._v_title)
+
+    desc = OrderedDict()
+    desc['time'] = tables.FloatCol(pos = 0)  # bin start
+    desc['count'] = tables.Int64Col(pos = 1)  # rows in bin
+    for c in table.colnames:
+        if c != 'time':
+            desc[c] = tables.FloatCol(pos = len(desc))  # sum of column in bin
+
+    src = table
+    for res in sorted(levels):
+        log.info('building rate pyramid level %ds of %s', res, table._v_pathname)
+        level = h5.createTable(group, 'r{:d}'.format(res), desc, 'counts and sums in {:d}s bins'.format(res),
+                               expectedrows = min(src.nrows, 10 ** 8 // res))
+        level.attrs.resolution = res
+        _rebin(src, level, res, src is not table, blocksize)
+        src = level
+
+    group._v_attrs.source_nrows = table.nrows  # to detect outdated pyramids
+    return group
+
+
+def _multiple(x, res):
+    q = float(x) / res
+    return q >= 1 and abs(q - round(q)) < 1e-9
+
+
+def pyramid_level(table, window, shift):
+    '''
+    the coarsest pyramid level of table that window and window shift are multiples of,
+    None if there is none or the pyramid is outdated
+    '''
+    try:
+        group = table._v_file.getNode(table._v_pathname + '_pyramid')
+    except tables.NoSuchNodeError:
+        return None
+    if getattr(group._v_attrs, 'source_nrows', None) != table.nrows:
+        log.warning('rate pyramid of %s is outdated', table._v_pathname)
+        return None
+    for level in sorted(group._f_iterNodes('Table'), key = lambda l:-l.attrs.resolution):
+        if level.nrows > 0 and _multiple(window, level.attrs.resolution) \
+                and _multiple(shift * window, level.attrs.resolution):
+            return level
+    return None
+
+
+def pyramid_averages(level, window, shift, weight, dtype, blocksize = 2 ** 16, progress = noop):
+    '''
+    like window_averages, but from the bins of a pyramid level, weight must not depend on any column,
+    windows start at the first bin instead of the first row
+    '''
+    assert not weight.fields
+    ta, tb, ia, ib = windows(pycolumn(level.col('time')), window, shift)
+    cols = [c for c in level.colnames if c != 'time']  # count and column sums
+
+    def values(rows, n):
+        data = np.empty((n, len(cols)))
+        for i, c in enumerate(cols):
+            data[:, i] = rows[c]
+        return data
+
+    sums = _window_sums(level, ia, ib, len(cols), values, blocksize, progress)
+
+    count = sums[:, 0]
+    w = float(weight(None))
+    averaged = np.empty(len(ta), dtype = dtype)
+    for i, c in enumerate(cols):
+        if c != 'count':
+            averaged[c] = sums[:, i] / count
+    averaged['time'] = (ta + tb) * 0.5  # interval center
+    averaged['count'] = count
+    averaged['weight'] = w * count / count
+    averaged['rate'] = count / window
+    return averaged
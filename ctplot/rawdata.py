@@ -14,6 +14,7 @@ import tables as t
 from progressbar import ProgressBar, Bar, Percentage, ETA
 import math
 from utils import set_attrs
+from rates import build_pyramid, NotSortedError
 from pkg_resources import resource_stream
 
 
@@ -787,7 +788,8 @@ def detect_and_sort(filenames, skip_unhandled):
 
 
 def raw_to_h5(filenames, out = "out.h5", handlers = available_handlers,
-              t0 = dp.parse('2004-01-01 00:00:00 +0000'), skip_on_assert = False, show_progress = True, ignore_errors = False, skip_unhandled = False):
+              t0 = dp.parse('2004-01-01 00:00:00 +0000'), skip_on_assert = False, show_progress = True, ignore_errors = False, skip_unhandled = False,
+              pyramid = False):
     """
     converts ASCII data to HDF5 tables
         filenames : iterable, filenames of all data files (events, weather, etc.) in any order
@@ -797,6 +799,7 @@ def raw_to_h5(filenames, out = "out.h5", handlers = available_handlers,
                     time is stored as 'time since t0' (default='2004-01-01 00:00:00 +0100')
     skip_on_assert: if True, skip lines that are invalid (if LineHandler.verify() raises AssertionError)
                     (default=False, exception is raised)
+          pyramid : if True, precompute rate pyramids of the tables (default=False)
     """
 
     _filenames = []
@@ -852,6 +855,7 @@ def raw_to_h5(filenames, out = "out.h5", handlers = available_handlers,
     with t.openFile(out, 'w', 'datafile created with raw_to_h5', filters = filters) as h5:
         h5.root._v_attrs.creationdate = dt.datetime.now(pytz.utc).isoformat()
         raw = h5.createGroup(h5.root, 'raw', 'raw data')
+        created = []  # tables created
 
         # create and fill raw data tables
         for handler, files in files_dict.iteritems():
@@ -864,9 +868,19 @@ def raw_to_h5(filenames, out = "out.h5", handlers = available_handlers,
             set_attrs(table, t0, handler.col_units)
             read_files(files, table.row, handler)
             table.flush()
+            created.append(table)
 
-    if show_progress:
-        pb.finish()
+        if show_progress:
+            pb.finish()
+
+        if pyramid:
+            for table in created:
+                if show_progress:
+                    print 'building rate pyramid: %s' % (table._v_pathname,)
+                try:
+                    build_pyramid(table)
+                except NotSortedError as e:
+                    print 'no rate pyramid,', e
 
 verbose = 0
 
@@ -896,6 +910,7 @@ def main():
     parser.add_argument('-v', '--verbose', action = 'count', help = 'show additional processing information')
     parser.add_argument('-k', '--keepgoing', action = 'store_true', help = 'keep going, do not stop on errors')
     parser.add_argument('-x', '--skip-unhandled', action = 'store_true', help = 'skip files with no handler')
+    parser.add_argument('-p', '--pyramid', action = 'store_true', help = 'precompute rate pyramids (1min, 10min, 1h, 1d bins) for fast rate plots')
     parser.add_argument('infiles', nargs = '+', help = 'input files, if a directory is given, all files in it and in its subdirectories are used')
 
     args = parser.parse_args()
@@ -912,7 +927,8 @@ def main():
 
 
     raw_to_h5(args.infiles, out = out, skip_on_assert = not args.noskip, show_progress = not args.quiet,
-              t0 = args.reftime, ignore_errors = args.keepgoing, skip_unhandled = args.skip_unhandled)
+              t0 = args.reftime, ignore_errors = args.keepgoing, skip_unhandled = args.skip_unhandled,
+              pyramid = args.pyramid)
 
 
 if __name__ == '__main__':
@@ -16,7 +16,7 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>. 
 #
-import pytz, json, time, re, os
+import pytz, json, time, re, os, hashlib
 import dateutil.parser as dp
 import datetime as dt
 from datetime import timedelta
@@ -163,13 +163,29 @@ def number_mathformat(value, precision = 4):
 
 
 def hashargs(*args, **kwargs):
-    return hash(json.dumps((args, kwargs), separators = (',', ':'), sort_keys = True))
+    'sha1 hex digest of the json serialized arguments, the same in every process and on every host'
+    return hashlib.sha1(json.dumps((args, kwargs), separators = (',', ':'), sort_keys = True)).hexdigest()
 
 
 def noop(*args, **kwargs):
     pass
 
 
+def source_record(filename):
+    '''path, size, mtime, device and inode of a file a cache entry is built from,
+    cheap enough to be checked before every use of the cache entry'''
+    st = os.stat(filename)
+    return [os.path.realpath(filename), st.st_size, st.st_mtime, st.st_dev, st.st_ino]
+
+
+def source_changed(record):
+    'True if the file of the source record was modified or replaced since'
+    try:
+        return source_record(record[0]) != list(record)
+    except OSError:
+        return True
+
+
 def getStatCpu():
     with open('/proc/stat') as stat:
         for line in stat:
@@ -221,6 +221,10 @@ function addHandlers(plot) {
                     vars.append('' + vv[1][i]);
                     if (vv[2][i].length > 0)
                         vars.append(' [' + vv[2][i] + ']');
+                    // value range from the table catalog
+                    var st = vv[4] && vv[4][vv[1][i]];
+                    if (st && st.min !== null)
+                        vars.append($('<span>').addClass('range').text(' (' + st.min.toPrecision(4) + ' .. ' + st.max.toPrecision(4) + ')'));
                 }
                 if (p.find(':input[name^="rw"]').val().replace(/\s+/, '') != '')
                     vars.append(', rate, count, weight');
@@ -540,6 +544,7 @@ function addPlotToSaved(settings) {
 }
 
 var xhr;
+var poll;
 
 function transformMinMaxFields() {
     console.debug('* transform min/max');
@@ -562,6 +567,91 @@ function transformMinMaxFields() {
     });
 }
 
+/** show the created plot with links and settings */
+function showPlot(data, query, settings) {
+    result = $('#result');
+    result.empty();
+    var img = data.png;
+    $('<img>').attr('src', img)
+    // add query string to prevent browser
+    // from showing cached image
+    .attr('alt', query).appendTo(result);
+
+    // links to pdf and svg
+    p = $('<p>').appendTo(result);
+    p.append('Download als ');
+    $('<a>').attr('href', data.pdf).text('PDF').appendTo(p);
+    p.append(', ');
+    $('<a>').attr('href', data.svg).text('SVG').appendTo(p);
+
+    // plot settings
+    result.append('<br>Einstellungen dieses Plots:<br>');
+    jsonsettings = JSON.stringify(settings);
+    result.append($('<textarea id="plotsettings">').text(jsonsettings));
+
+    // plot url
+    result.append('<br>Diesen Plot auf einer Webseite einbinden:<br>');
+    ploturl = $(location).attr('href').replace(/[#?].*/, '') + 'plot?' + query.replace(/a=plot/, 'a=png');
+    result.append($('<textarea id="ploturl">').text('<img src="' + ploturl + '" />'));
+
+    // store settings in cookie
+    $.extend(settings, data);
+    // append plot image urls to
+    settings['url'] = ploturl;
+    // save plot button
+    p.append(', ');
+    $('<input>').attr('type', 'image').attr('src', 'img/disk.png').attr('title', 'Diagramm speichern').attr('value', 'Diagramm speichern').click(function() {
+        addPlotToSaved(settings);
+        $(this).hide(speed);
+        savePlots();
+    }).appendTo(p);
+
+    // scroll to plot section
+    $('nav a[href="#output"]').click();
+}
+
+function plotError(xhr, text, error) {
+    $('#result').empty();
+    $('#error').html('<p>plot error, check input values!</p>' + '<p>"' + text + '"</p><p>"' + error + '"</p>' + '<p style="color: red;">responseText:</p>' + xhr['responseText']);
+    // scroll to plot section
+    $('nav a[href="#output"]').click();
+}
+
+/** poll the status of a plot job until it is done */
+function waitForPlot(job, query, settings) {
+    if (job.state == 'done') {
+        xhr = $.ajax({
+            data : {
+                a : 'result',
+                id : job.id
+            },
+            success : function(data) {
+                showPlot(data, query, settings);
+            },
+            error : plotError
+        });
+    } else if (job.state == 'error' || job.state == 'unknown') {
+        plotError({
+            responseText : '<pre>' + $('<div>').text(job.error || 'unknown plot job').html() + '</pre>'
+        }, job.state, job.id);
+    } else {
+        var info = job.state == 'queued' ? 'wartet (' + job.queue + ' Plots in der Warteschlange)' : Math.round(100 * job.progress) + '%';
+        $('#result p').first().html('Plot wird erstellt, bitte warten&hellip; ' + info);
+        poll = setTimeout(function() {
+            xhr = $.ajax({
+                data : {
+                    a : 'status',
+                    id : job.id
+                },
+                success : function(job) {
+                    waitForPlot(job, query, settings);
+                },
+                error : plotError
+            });
+        }, 500);
+    }
+}
+
 function initSubmit() {
     console.debug('* init submit');
     // hand submission of plot request and reception of the plot
@@ -571,6 +661,7 @@ function initSubmit() {
         } catch (e) {
             // if there was no previous request, ignore errors
         }
+        clearTimeout(poll);
 
         // the form (all input fields) as url query string
 
@@ -591,57 +682,15 @@ function initSubmit() {
         // scroll to plot section
         $('nav a[href="#output"]').click();
 
-        // perform ajax request to get the plot (created on
-        // server)
+        // submit the plot job to the server and poll its status until
+        // the plot is created
         $('#error').empty();
         xhr = $.ajax({
-            data : query,
-            success : function(data) {
-                result.empty();
-                var img = data.png;
-                $('<img>').attr('src', img)
-                // add query string to prevent browser
-                // from showing cached image
-                .attr('alt', query).appendTo(result);
-
-                // links to pdf and svg
-                p = $('<p>').appendTo(result);
-                p.append('Download als ');
-                $('<a>').attr('href', data.pdf).text('PDF').appendTo(p);
-                p.append(', ');
-                $('<a>').attr('href', data.svg).text('SVG').appendTo(p);
-
-                // plot settings
-                result.append('<br>Einstellungen dieses Plots:<br>');
-                jsonsettings = JSON.stringify(settings);
-                result.append($('<textarea id="plotsettings">').text(jsonsettings));
-
-                // plot url
-                result.append('<br>Diesen Plot auf einer Webseite einbinden:<br>');
-                ploturl = $(location).attr('href').replace(/[#?].*/, '') + 'plot?' + query.replace(/a=plot/, 'a=png');
-                result.append($('<textarea id="ploturl">').text('<img src="' + ploturl + '" />'));
-
-                // store settings in cookie
-                $.extend(settings, data);
-                // append plot image urls to
-                settings['url'] = ploturl;
-                // save plot button
-                p.append(', ');
-                $('<input>').attr('type', 'image').attr('src', 'img/disk.png').attr('title', 'Diagramm speichern').attr('value', 'Diagramm speichern').click(function() {
-                    addPlotToSaved(settings);
-                    $(this).hide(speed);
-                    savePlots();
-                }).appendTo(p);
-
-                // scroll to plot section
-                $('nav a[href="#output"]').click();
+            data : query.replace(/a=plot/, 'a=submit'),
+            success : function(job) {
+                waitForPlot(job, query, settings);
             },
-            error : function(xhr, text, error) {
-                $('#result').empty();
-                $('#error').html('<p>plot error, check input values!</p>' + '<p>"' + text + '"</p><p>"' + error + '"</p>' + '<p style="color: red;">responseText:</p>' + xhr['responseText']);
-                // scroll to plot section
-                $('nav a[href="#output"]').click();
-            }
+            error : plotError
         });
 
         return false;
@@ -1,19 +1,123 @@
 #!/usr/bin/env python
 
-import os
+import os, sys
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.web import Application, RequestHandler
 from tornado.wsgi import WSGIContainer
 from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes
 from tornado.ioloop import IOLoop
 from ctplot.wsgi import application
 
+quick_actions = ('status', 'result')  # answered from the job files, never wait for a render
+
+
+def call_application(environ):
+    'call the wsgi application, return status, headers and the whole body'
+    response = []
+
+    def start_response(status, headers, exc_info = None):
+        response[:] = [status, headers]
+
+    body = application(environ, start_response)
+    try:
+        data = ''.join(body)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    return response[0], response[1], data
+
+
+def in_thread(pool, f, *args):
+    'call f(*args) in a thread of pool, return a future resolved on the IOLoop'
+    future = Future()
+    loop = IOLoop.current()
+
+    def call():
+        try:
+            result = f(*args)
+        except Exception as e:
+            loop.add_callback(future.set_exception, e)
+        else:
+            loop.add_callback(future.set_result, result)
+
+    pool.apply_async(call)
+    return future
+
+
+class CtplotHandler(RequestHandler):
+    '''serves static files, health checks and job status directly on the IOLoop,
+    plot files, metrics and requests that may render plots or scan the data files
+    are served by a thread of the pool, the renders themselves run in the render
+    processes of ctplot.wsgi'''
+
+    SUPPORTED_METHODS = ('GET', 'HEAD', 'POST')
+
+    def initialize(self, pool):
+        self.pool = pool
+
+
+    def compute_etag(self):
+        return None  # the application sets etags where they make sense
+
+
+    def blocking(self):
+        'True if serving the request may take a while'
+        path = self.request.path
+        if path.startswith('/plots') or path == '/metrics':  # read from the file system
+            return True
+        if path == '/webplot.py' or path.startswith('/plot'):
+            return self.get_argument('a', None) not in quick_actions
+        return False  # static files and health checks, served from memory
+
+
+    @gen.coroutine
+    def _serve(self):
+        environ = WSGIContainer.environ(self.request)
+        if self.blocking():
+            status, headers, data = yield in_thread(self.pool, call_application, environ)
+        else:
+            status, headers, data = call_application(environ)
+
+        code, reason = status.split(' ', 1)
+        self.set_status(int(code), reason)
+        self.clear_header('Content-Type')
+        for k, v in headers:
+            self.add_header(k, v)
+        if data and self.request.method != 'HEAD':
+            self.write(data)
+        self.finish()
+
+    get = head = post = _serve
+
+
+def make_app(threads):
+    'tornado application serving ctplot, with up to threads requests waiting for renders at once'
+    return Application([(r'.*', CtplotHandler, {'pool':ThreadPool(threads)})])
+
 
 def main():
     port = int(os.environ['CTPLOT_PORT']) if 'CTPLOT_PORT' in os.environ else 8080
+    threads = int(os.environ['CTPLOT_THREADS']) if 'CTPLOT_THREADS' in os.environ else 32
+    workers = int(os.environ['CTPLOT_WORKERS']) if 'CTPLOT_WORKERS' in os.environ else 1
     print 'listening on', port
 
-    http_server = HTTPServer(WSGIContainer(application))
-    http_server.listen(port)
-    IOLoop.instance().start()
+    sockets = bind_sockets(port)
+    if workers != 1:
+        workers = workers or cpu_count()
+        if 'CTPLOT_RENDERERS' not in os.environ:  # share the cores among the workers
+            os.environ['CTPLOT_RENDERERS'] = str(max(1, cpu_count() // workers))
+        # the workers share the socket, caches, catalog and job files are shared through the
+        # file system, this process restarts workers that die and never returns
+        fork_processes(workers, max_restarts = sys.maxint)
+
+    http_server = HTTPServer(make_app(threads))
+    http_server.add_sockets(sockets)
+    IOLoop.current().start()
 
 if __name__ == '__main__':
     main()
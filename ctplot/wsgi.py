@@ -1,22 +1,34 @@
 #!/usr/bin/env python
 
-import os, json, random, string
+import os, re, json, errno, random, string, atexit, hashlib, signal, logging
 from os.path import join, abspath, basename
 from mimetypes import guess_type
-from time import  time
+from time import time, sleep
 from cgi import FieldStorage
-from threading import Lock
-from pkg_resources import resource_string, resource_exists, resource_isdir, resource_listdir
+from threading import Lock, Thread, Event
+from tempfile import mkstemp
+from traceback import format_exc
+from gzip import GzipFile
+from cStringIO import StringIO
+from collections import namedtuple
+from email.utils import parsedate_tz, mktime_tz
+from wsgiref.handlers import format_date_time
+from multiprocessing import Pool, cpu_count
+from pkg_resources import resource_string, resource_isdir, resource_listdir, resource_filename
 
 import matplotlib
 matplotlib.use('Agg')  # headless backend
 
 import ctplot.plot
-from ctplot.utils import hashargs
+from ctplot.utils import hashargs, source_record, source_changed
+from ctplot.catalog import Catalog, catalog_file
+import ctplot.metrics as metrics
 
 
 
 
+log = logging.getLogger('wsgi')
+
 _config = None
 
 def get_config():
@@ -33,13 +45,26 @@ def get_config():
     _config = {'cachedir':join(basedir, 'cache'),
                'datadir':join(basedir, 'data'),
                'plotdir':join(basedir, 'plots'),
-               'sessiondir':join(basedir, 'sessions')}
+               'sessiondir':join(basedir, 'sessions'),
+               'jobs':'1',  # processes evaluating the data of a plot rendered in the web process
+               'renderers':str(cpu_count()),  # render processes, 0 renders in the web process
+               'renderqueue':'100',  # plots waiting for a render process
+               'rendertimeout':'3600',  # seconds a plot job may take, 0 waits forever
+               'exprcachesize':'1024',  # MB
+               'sendfile':'',  # X-Sendfile or X-Accel-Redirect to let the web server send plot files
+               'sendfileprefix':''}  # path (X-Sendfile) or uri (X-Accel-Redirect) of plotdir for the web server
 
     for k in _config.keys():
-        ek = prefix + k.upper()
+        ek = (prefix + k).upper()
         if ek in env:
             _config[k] = env[ek]
 
+    if int(_config['jobs'] or 1) > 1 and int(_config['renderers'] or 0) > 0:
+        log.warning('ignoring CTPLOT_JOBS=%s, render processes cannot start processes of their own, '
+                    'set CTPLOT_RENDERERS=0 to evaluate the data in parallel', _config['jobs'])
+
+    if _config['cachedir']:  # metrics shared with render and other server processes
+        metrics.configure(join(_config['cachedir'], 'metrics'))
     return _config
 
 def getpath(environ):
@@ -51,10 +76,21 @@ def getpath(environ):
 # see http://webpython.codepoint.net/wsgi_application_interface
 def application(environ, start_response):
     path = getpath(environ)
-    if path == '/webplot.py' or path.startswith('/plot'):
-        return dynamic_content(environ, start_response)
-    else:
-        return static_content(environ, start_response)
+    t = time()
+    try:
+        if path == '/metrics':
+            environ['ctplot.handler'] = 'metrics'
+            return serve_metrics(start_response)
+        elif path == '/health':
+            environ['ctplot.handler'] = 'health'
+            return serve_health(start_response, get_config())
+        elif path == '/webplot.py' or path.startswith('/plot'):
+            return dynamic_content(environ, start_response)
+        else:
+            return static_content(environ, start_response)
+    finally:
+        metrics.observe('ctplot_request_seconds', time() - t, handler = environ.get('ctplot.handler', 'static'))
+        metrics.flush()
 
 # http://www.mobify.com/blog/beginners-guide-to-http-cache-headers/
 # http://www.mnot.net/cache_docs/
@@ -76,6 +112,119 @@ def content_type(path = ''):
     return 'Content-Type', mime_type
 
 
+def not_modified(environ, etag, mtime):
+    'True if the client already has the version with etag and mtime'
+    inm = environ.get('HTTP_IF_NONE_MATCH')
+    if inm:  # takes precedence over If-Modified-Since
+        return inm.strip() == '*' or etag in [t.strip() for t in inm.split(',')]
+    ims = parsedate_tz(environ.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return mtime is not None and ims is not None and int(mtime) <= mktime_tz(ims)
+
+
+def byte_range(environ, etag, size):
+    '''the range (start, stop) requested by the client, None for the whole content,
+    False if it is not satisfiable, only single ranges are supported'''
+    m = re.match(r'^bytes=(\d*)-(\d*)$', environ.get('HTTP_RANGE', '').strip())
+    if not m or not any(m.groups()):
+        return None
+    if environ.get('HTTP_IF_RANGE', etag) != etag:  # content changed, send all of it
+        return None
+    a, b = m.groups()
+    if not a:  # suffix range, the last b bytes
+        start, stop = max(0, size - int(b)), size
+    else:
+        start, stop = int(a), min(size, int(b) + 1) if b else size
+    return (start, stop) if start < stop else False
+
+
+def read_blocks(f, start = 0, stop = None, blocksize = 2 ** 16):
+    'yield the bytes start to stop of file f in blocks and close it'
+    with f:
+        f.seek(start)
+        n = stop - start if stop is not None else -1  # bytes left
+        while n:
+            block = f.read(blocksize if n < 0 else min(n, blocksize))
+            if not block:
+                break
+            n -= len(block)
+            yield block
+
+
+def serve_data(environ, start_response, data, headers, etag, mtime = None):
+    '''send data, 304 if the client has it already or the requested range of it,
+    data may be an open file, which is streamed and closed'''
+    isfile = hasattr(data, 'read')
+    size = os.fstat(data.fileno()).st_size if isfile else len(data)
+    headers = headers + [('ETag', etag), ('Accept-Ranges', 'bytes')]
+    if mtime is not None:
+        headers.append(('Last-Modified', format_date_time(mtime)))
+
+    r = byte_range(environ, etag, size)
+    if not_modified(environ, etag, mtime) or r is False:
+        if isfile:
+            data.close()
+        if r is False:
+            start_response('416 Requested Range Not Satisfiable', headers + [('Content-Range', 'bytes */{}'.format(size))])
+        else:
+            start_response('304 Not Modified', headers)
+        return []
+
+    if r:
+        start, stop = r
+        start_response('206 Partial Content', headers + [('Content-Range', 'bytes {}-{}/{}'.format(start, stop - 1, size)),
+                                                         ('Content-Length', str(stop - start))])
+        return read_blocks(data, start, stop) if isfile else [data[start:stop]]
+
+    start_response('200 OK', headers + [('Content-Length', str(size))])
+    if isfile:  # zero copy if the server supports it
+        wrapper = environ.get('wsgi.file_wrapper')
+        return wrapper(data, 2 ** 16) if wrapper else read_blocks(data)
+    return [data]
+
+
+Resource = namedtuple('Resource', ('data', 'gzipped', 'etag', 'mtime', 'mimetype'))
+
+def make_resource(names, data, mimetype):
+    'resource made of the package files names'
+    try:
+        mtime = max(os.path.getmtime(resource_filename('ctplot', n)) for n in names)
+    except Exception:  # not a plain file, e.g. in a zipped egg
+        mtime = None
+
+    gzipped = None
+    if mimetype.startswith('text/') or mimetype in ('application/javascript', 'image/svg+xml'):
+        buf = StringIO()
+        with GzipFile(fileobj = buf, mode = 'wb', mtime = 0) as f:
+            f.write(data)
+        if len(buf.getvalue()) < len(data):
+            gzipped = buf.getvalue()
+
+    return Resource(data, gzipped, hashlib.sha1(data).hexdigest(), mtime, mimetype)
+
+
+def load_resources(path = 'web'):
+    'all files below path and the combined java scripts with their gzipped variants, etags and mime types'
+    resources, dirs = {}, set([path])
+    for n in resource_listdir('ctplot', path):
+        n = path + '/' + n
+        if resource_isdir('ctplot', n):
+            r, d = load_resources(n)
+            resources.update(r)
+            dirs.update(d)
+        else:
+            resources[n] = make_resource([n], resource_string('ctplot', n), content_type(n)[1])
+
+    if path == 'web':
+        js = sorted(n for n in resources if n.startswith('web/js/'))
+        data = ''.join('\n// {}\n\n'.format(basename(n)) + resources[n].data for n in js)
+        resources['web/js'] = make_resource(js, data, content_type('combined.js')[1])  # served instead of the directory
+    return resources, dirs
+
+
+# package resources, they do not change while running
+resources, resource_dirs = load_resources()
+
+
 def static_content(environ, start_response):
     path = getpath(environ)
 
@@ -86,25 +235,36 @@ def static_content(environ, start_response):
     if path == '/':
         path = 'web/index.html'  # map / to index.html
     else:
-        path = ('web/' + path).replace('//', '/')
+        path = ('web/' + path).replace('//', '/').rstrip('/')
 
-    if path == 'web/js':  # combined java scripts
-        scripts = {}
-        for s in resource_listdir('ctplot', 'web/js'):
-            scripts[s] = '\n// {}\n\n'.format(s) + resource_string('ctplot', 'web/js/' + s)
-        start_response('200 OK', [content_type('combined.js'), cc_cache])
-        return [scripts[k] for k in sorted(scripts.keys())]
+    if path in resources:
+        r = resources[path]
+        headers = [('Content-Type', r.mimetype), cc_cache, ('Vary', 'Accept-Encoding')]
+        if r.gzipped and accepts_gzip(environ):
+            return serve_data(environ, start_response, r.gzipped, headers + [('Content-Encoding', 'gzip')],
+                              '"{}-gz"'.format(r.etag), r.mtime)
+        return serve_data(environ, start_response, r.data, headers, '"{}"'.format(r.etag), r.mtime)
 
-    if not resource_exists('ctplot', path):  # 404
+    elif path in resource_dirs:  # 403
+        start_response('403 Forbidden', [content_type()])
+        return ['403 Forbidden']
+
+    else:  # 404
         start_response('404 Not Found', [content_type()])
         return ['404\n', '{} not found!'.format(path)]
 
-    elif resource_isdir('ctplot', path):  # 403
-        start_response('403 Forbidden', [content_type()])
-        return ['403 Forbidden']
-    else:
-        start_response('200 OK', [content_type(path), cc_cache])
-        return resource_string('ctplot', path)
+
+def accepts_gzip(environ):
+    'True if the client accepts gzip content encoding'
+    for coding in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        coding = coding.split(';')
+        if coding[0].strip() in ('gzip', '*'):
+            q = [p.strip()[2:] for p in coding[1:] if p.strip().startswith('q=')]
+            try:
+                return not q or float(q[0]) > 0
+            except ValueError:
+                return False
+    return False
 
 
 
@@ -113,20 +273,45 @@ def dynamic_content(environ, start_response):
     config = get_config()
 
     if path.startswith('/plots'):
-        return serve_plot(path, start_response, config)
+        environ['ctplot.handler'] = 'plots'
+        return serve_plot(path, start_response, config, environ)
     else:
         return handle_action(environ, start_response, config)
 
 
 
-def serve_plot(path, start_response, config):
-    with open(join(config['plotdir'], basename(path))) as f:
-        start_response('200 OK', [content_type(path), cc_cache])
-        return [f.read()]
+def serve_plot(path, start_response, config, environ = {}):
+    filename = join(config['plotdir'], basename(path))
+    if not os.path.isfile(filename):
+        try:
+            render_format(filename, config)
+        except ServerBusy as e:
+            start_response('503 Service Unavailable', [content_type(), cc_nocache, ('Retry-After', '10')])
+            return [str(e)]
+    try:
+        f = open(filename)
+    except IOError:  # removed from plotdir
+        if plot_index: plot_index.discard(basename(path))
+        start_response('404 Not Found', [content_type()])
+        return ['404\n', '{} not found!'.format(basename(path))]
+
+    if config['sendfile']:  # served by the web server in front of us
+        f.close()
+        if config['sendfile'].lower() == 'x-accel-redirect':  # nginx, plotdir is an internal location
+            header = 'X-Accel-Redirect', (config['sendfileprefix'] or '/plots/') + basename(path)
+        else:  # apache mod_xsendfile, lighttpd
+            header = 'X-Sendfile', (config['sendfileprefix'] or config['plotdir'] + '/') + basename(path)
+        start_response('200 OK', [content_type(path), cc_cache, header])
+        return []
 
+    # plot names are hashes of settings and data files, size and mtime change if it is rendered again
+    st = os.fstat(f.fileno())
+    etag = '"{}-{:x}-{:x}"'.format(basename(path), st.st_size, int(st.st_mtime * 1000))
+    return serve_data(environ, start_response, f, [content_type(path), cc_cache], etag, st.st_mtime)
 
-def serve_json(data, start_response):
-    start_response('200 OK', [content_type(), cc_nocache])
+
+def serve_json(data, start_response, status = '200 OK'):
+    start_response(status, [content_type(), cc_nocache])
     return [json.dumps(data)]
 
 
@@ -135,44 +320,492 @@ def serve_plain(data, start_response):
     return [data]
 
 
+def serve_metrics(start_response):
+    'counters and timings of all processes in the prometheus text format'
+    metrics.gauge('ctplot_render_queue', pending)
+    start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'), cc_nocache])
+    return [metrics.exposition()]
+
+
+def serve_health(start_response, config):
+    'status of this server process, 503 if it cannot read the data or write plots and caches'
+    checks = {'datadir':os.access(config['datadir'], os.R_OK | os.X_OK),
+              'plotdir':os.access(config['plotdir'], os.W_OK | os.X_OK),
+              'cachedir':os.access(config['cachedir'], os.W_OK | os.X_OK)}
+    ok = all(checks.values())
+    start_response('200 OK' if ok else '503 Service Unavailable', [content_type(), cc_nocache])
+    return [json.dumps({'status':'ok' if ok else 'failing', 'checks':checks, 'pid':os.getpid(), 'queue':pending})]
+
+
+
+class ServerBusy(RuntimeError):
+    pass
+
+
+plot_lock = Lock()  # serializes plot creation if there are no render processes
+render_lock = Lock()  # guards renderers, pending and inflight
+renderers = None
+pending = 0  # plots rendering or waiting for a render process
+inflight = {}  # job id: event set when the plot submitted by this process is finished
+plot_index = None  # names of the files in plotdir
+plot_sources = {}  # job id: source records of the cached plot
+
+
+def get_renderers(config):
+    'the pool of render processes, started on first use, None if plots are rendered in the web process'
+    global renderers
+    with render_lock:
+        if renderers is None:
+            n = int(config['renderers'] or 0)
+            renderers = Pool(n) if n > 0 else False
+            if renderers:
+                atexit.register(renderers.terminate)
+        return renderers or None
+
+
+def source_files(settings):
+    'the data files used by the plot with settings'
+    return sorted(set(os.path.realpath(v.split(':')[0]) for k, v in settings.items() if v and re.match(r'^s\d+$', k)))
+
+
+def plot_name(settings, config):
+    'job id and file name (w/o extension) of the plot with settings'
+    settings = dict((k, v) for k, v in settings.items() if v)  # empty settings are the same as missing ones
+    id = 'plot{}'.format(hashargs(settings, source_files(settings)))
+    return id, os.path.join(config['plotdir'], id).replace('\\', '/')
+
+
+def plot_exists(filename, config):
+    'True if filename exists, files in plotdir are looked up in an index instead of calling stat'
+    global plot_index
+    if plot_index is None:
+        plot_index = set(os.listdir(config['plotdir']))
+    name = basename(filename)
+    if name not in plot_index and os.path.isfile(filename):  # created by another process
+        plot_index.add(name)
+    return name in plot_index
+
+
+def cached_plot(name, config):
+    'the image files of the plot if it is cached and its data files did not change, else None'
+    if not config['cachedir'] or not plot_exists(name + '.png', config):
+        return None
+
+    id = basename(name)
+    sources = plot_sources.get(id)
+    if sources is None or any(map(source_changed, sources)):
+        # look for the sources recorded with the plot, it may have been rendered again by another process
+        status = read_job(id, config) or {}
+        sources = status.get('sources') if status.get('state') == 'done' else None
+        if sources is None or any(map(source_changed, sources)):
+            return None
+        plot_sources[id] = sources
+
+    return dict([(e, name + '.' + e) for e in ['png', 'svg', 'pdf']])
+
+
+def enqueue(config):
+    global pending
+    with render_lock:
+        if pending >= int(config['renderers'] or 0) + int(config['renderqueue'] or 0):
+            raise ServerBusy('too many plots in queue, try again later')
+        pending += 1
+        metrics.gauge('ctplot_render_queue', pending)
+
+
+def dequeue():
+    global pending
+    with render_lock:
+        pending -= 1
+        metrics.gauge('ctplot_render_queue', pending)
 
-plot_lock = Lock()
 
 def make_plot(settings, config):
-    basename = 'plot{}'.format(hashargs(settings))
-    name = os.path.join(config['plotdir'], basename).replace('\\', '/')
+    id, name = plot_name(settings, config)
 
     # try to get plot from cache
-    if config['cachedir'] and os.path.isfile(name + '.png'):
-        return dict([(e, name + '.' + e) for e in ['png', 'svg', 'pdf']])
+    images = cached_plot(name, config)
+    if images:
+        metrics.inc('ctplot_cache_requests_total', cache = 'plot', result = 'hit')
+        return images
+
+    # render it or wait for the identical plot already being rendered
+    for attempt in range(3):
+        status = wait_job(submit_plot(settings, config), config)
+        if status['state'] not in ('queued', 'running'):  # else the process rendering it died
+            break
+    if status['state'] != 'done':
+        raise RuntimeError('plot {} failed\n{}'.format(id, status.get('error', '')))
+    return dict((k, os.path.join(config['plotdir'], basename(v))) for k, v in status['result'].items())
+
+
+
+# state of plot jobs, kept in <plotdir>/<id>.job as json, so all web processes see it,
+# while a job is queued or running <plotdir>/<id>.lock holds the pid of the web process that submitted it
+# and, once it runs, the pid of the process rendering it
+def valid_id(id):
+    return bool(re.match(r'^plot[-\w]+$', id))
+
+
+def job_file(id, config, ext = '.job'):
+    if not valid_id(id):
+        raise ValueError('invalid job id {}'.format(id))
+    return os.path.join(config['plotdir'], id + ext)
 
-    else:
-        # lock long running plot creation
-        with plot_lock:
-            p = ctplot.plot.Plot(config, **settings)
-            return p.save(name)
+
+def write_job(id, config, **status):
+    fd, tmp = mkstemp('.tmp', id, config['plotdir'])
+    with os.fdopen(fd, 'w') as f:
+        json.dump(status, f)
+    os.rename(tmp, job_file(id, config))  # atomic, readers never see partial files
+
+
+def read_job(id, config):
+    try:
+        with open(job_file(id, config)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def lock_pids(path):
+    'pids of the submitting and the rendering process in the lock file, [] if there is none'
+    try:
+        with open(path) as f:
+            return map(int, f.read().split())
+    except (IOError, ValueError):  # removed meanwhile or still being written
+        return []
+
+
+def stale_lock(path):
+    'True if one of the processes holding the lock file does not exist anymore'
+    for pid in lock_pids(path):
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                return True
+    return False
+
+
+def take_lock(id, config):
+    'create the lock file of job id, False if another process holds it'
+    path = job_file(id, config, '.lock')
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            if not stale_lock(path):
+                return False
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    with os.fdopen(fd, 'w') as f:
+        f.write(str(os.getpid()))
+    return True
+
+
+def holds_lock(id, config, render = False):
+    '''True if this process submitted (or with render = True, renders) job id
+    and its lock file still exists'''
+    pids = lock_pids(job_file(id, config, '.lock'))
+    return os.getpid() in (pids[1:] if render else pids[:1])
+
+
+def release_lock(id, config):
+    try:
+        os.remove(job_file(id, config, '.lock'))
+    except OSError:
+        pass
+
+
+def run_job(settings, config, name):
+    '''render a plot submitted as job, reporting its progress in the job file,
+    the job file and lock are left alone once another process took the job over'''
+    id = basename(name)
+    status = {}
+    finished = Event()
+    p = None
+
+    def report():
+        while not finished.wait(0.5):
+            if p and holds_lock(id, config, render = True):
+                write_job(id, config, state = 'running', progress = p.progress)
+
+    t = Thread(target = report)
+    t.daemon = True
+    try:
+        try:  # the lock is stale if this process dies, no lock means the job was given up while queued
+            fd = os.open(job_file(id, config, '.lock'), os.O_WRONLY | os.O_APPEND)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        with os.fdopen(fd, 'a') as f:
+            f.write(' {}'.format(os.getpid()))
+        write_job(id, config, state = 'running', progress = 0)
+        t.start()
+        sources = [source_record(filename) for filename in source_files(settings)]  # before reading them
+        for e in vector_formats + ['npz']:  # outdated, rendered again on request
+            if os.path.isfile(name + '.' + e):
+                os.remove(name + '.' + e)
+        p = ctplot.plot.Plot(config, **settings)
+        p.save(name, ('png',))
+        fd, tmp = mkstemp('.tmp', id, config['plotdir'])
+        os.close(fd)
+        if p.save_histograms(tmp):
+            os.rename(tmp, name + '.npz')
+        else:
+            os.remove(tmp)
+        status = dict(state = 'done', progress = 1, result = dict((e, 'plots/{}.{}'.format(id, e)) for e in ['png'] + vector_formats),
+                      sources = sources, settings = settings)
+    except Exception:
+        status = dict(state = 'error', progress = 1, error = format_exc())
+    finally:
+        finished.set()
+        if t.ident:
+            t.join()
+        try:
+            if holds_lock(id, config, render = True):
+                try:
+                    write_job(id, config, **status)
+                finally:
+                    release_lock(id, config)
+        finally:
+            metrics.flush(True)  # may run in a render process, which is terminated without exit handlers
+
+
+def submit_plot(settings, config):
+    '''start rendering the plot in the background, return the job id,
+    identical plots submitted while it is queued or running share the job'''
+    id, name = plot_name(settings, config)
+
+    if cached_plot(name, config):  # its job file is done
+        metrics.inc('ctplot_cache_requests_total', cache = 'plot', result = 'hit')
+        return id
+
+    with render_lock:
+        if id in inflight:
+            metrics.inc('ctplot_cache_requests_total', cache = 'plot', result = 'shared')
+            return id
+    if not take_lock(id, config):  # submitted by another process
+        metrics.inc('ctplot_cache_requests_total', cache = 'plot', result = 'shared')
+        return id
+    metrics.inc('ctplot_cache_requests_total', cache = 'plot', result = 'miss')
+
+    pool = get_renderers(config)
+    try:
+        enqueue(config)
+    except:
+        release_lock(id, config)
+        raise
+
+    event = Event()
+    with render_lock:
+        inflight[id] = event
+
+    def finished():
+        with render_lock:
+            del inflight[id]
+        dequeue()
+        event.set()
+
+    def fail(error):
+        if holds_lock(id, config):  # not yet taken over by another process
+            try:
+                write_job(id, config, state = 'error', progress = 1, error = 'plot {} {}'.format(id, error))
+            finally:
+                release_lock(id, config)
+
+    def watch(result):
+        # waits for the end of the render, the result never gets ready if the render process dies,
+        # a render taking longer than rendertimeout is stopped by killing its process,
+        # the pool replaces it, the slot stays taken until the process is gone
+        timeout = float(config['rendertimeout'] or 0)
+        lock = job_file(id, config, '.lock')
+        started, error = None, None
+        while not result.ready():
+            result.wait(1)
+            pids = lock_pids(lock)
+            if result.ready() or len(pids) < 2:  # done or still waiting for a render process
+                continue
+            started = started or time()
+            if stale_lock(lock):
+                error = 'render process died'
+                break
+            if timeout and time() - started > timeout:
+                error = 'timed out after {:.0f}s'.format(timeout)
+                for pid in pids[1:]:
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+                while not stale_lock(lock):
+                    sleep(0.1)
+                break
+        if not error and not result.successful():  # failed outside of the job
+            try:
+                result.get()
+            except Exception as e:
+                error = 'failed: {}'.format(e)
+        try:
+            if error:
+                fail(error)
+        finally:
+            finished()
+
+    try:
+        write_job(id, config, state = 'queued', progress = 0)
+        if pool:
+            # pool processes are daemons and cannot start their own extraction processes
+            result = pool.apply_async(run_job, (settings, dict(config, jobs = 1), name))
+            t = Thread(target = watch, args = (result,))
+            t.daemon = True
+            t.start()
+        else:
+            def run():
+                try:
+                    with plot_lock:
+                        run_job(settings, config, name)
+                except Exception as e:  # failed outside of the job
+                    fail('failed: {}'.format(e))
+                finally:
+                    finished()
+            Thread(target = run).start()
+    except:
+        release_lock(id, config)
+        finished()
+        raise
+    return id
+
+
+def wait_lock(id, config):
+    'wait until the lock of job id is released'
+    lock = job_file(id, config, '.lock')
+    while os.path.exists(lock):
+        if stale_lock(lock):
+            release_lock(id, config)
+        else:
+            sleep(0.1)
+
+
+def wait_job(id, config):
+    'wait until job id is finished, return its status'
+    with render_lock:
+        event = inflight.get(id)
+    if event:
+        event.wait()
+    wait_lock(id, config)  # rendered by another process
+    return job_status(id, config)
+
+
+# jobs render the png only, the vector formats are rendered from the settings in
+# the job file on first request, with the histograms filled by the job stored in
+# <plotdir>/<id>.npz and the other data read from the expression cache
+vector_formats = ['pdf', 'svg']
+
+def save_format(settings, config, name, ext):
+    p = ctplot.plot.Plot(config, **dict((str(k), v) for k, v in settings.items()))
+    if os.path.isfile(name + '.npz'):
+        p.load_histograms(name + '.npz')
+    tmp = p.save(name + '-tmp', (ext,))[ext]
+    os.rename(tmp, name + '.' + ext)  # atomic, readers never see partial files
+    metrics.flush(True)  # may run in a render process, which is terminated without exit handlers
+
+
+def render_format(filename, config):
+    'render the missing file plot<hash>.<ext> of a finished job in a vector format'
+    id, ext = os.path.splitext(basename(filename))
+    ext = ext[1:]
+    if ext not in vector_formats or not re.match(r'^plot[-\w]+$', id):
+        return
+    status = read_job(id, config)
+    if not status or status['state'] != 'done' or 'settings' not in status:
+        return
+    if any(map(source_changed, status.get('sources', []))):
+        # the png, the stored histograms and the cached expressions are outdated, make the plot again
+        make_plot(status['settings'], config)
+        status = read_job(id, config)
+        if not status or status['state'] != 'done':
+            return
+
+    key = '{}-{}'.format(id, ext)  # lock for rendering this format
+    if not take_lock(key, config):
+        wait_lock(key, config)
+        return
+    try:
+        enqueue(config)
+    except:
+        release_lock(key, config)
+        raise
+    try:
+        name = os.path.join(config['plotdir'], id)
+        pool = get_renderers(config)
+        if pool:
+            pool.apply(save_format, (status['settings'], dict(config, jobs = 1), name, ext))
+        else:
+            with plot_lock:
+                save_format(status['settings'], config, name, ext)
+    finally:
+        dequeue()
+        release_lock(key, config)
+
+
+def job_status(id, config):
+    'state (queued, running, done, error or unknown), progress and result of job id'
+    if not valid_id(id):
+        return {'id':id, 'state':'error', 'error':'invalid job id {}'.format(id), 'queue':pending}
+    status = read_job(id, config) or {'state':'unknown'}
+    if status['state'] not in ('queued', 'running') and os.path.exists(job_file(id, config, '.lock')):
+        status = {'state':'queued', 'progress':0}  # resubmitted, job file not yet updated
+    status = dict((k, v) for k, v in status.items() if k in ('state', 'progress', 'result', 'error'))
+    status['id'] = id
+    status['queue'] = pending  # plots rendering or waiting in this process
+    return status
 
 
 def randomChars(n):
     return ''.join(random.choice(string.ascii_lowercase + string.ascii_uppercase + string.digits) for _ in range(n))
 
-available_tables = None
+catalogs = {}  # (datadir, catalogfile) -> table catalog
+catalog_lock = Lock()
+
+def get_catalog(config):
+    'the table catalog of datadir, kept in cachedir and shared with the other server processes'
+    catalogfile = catalog_file(config['cachedir']) if config['cachedir'] else None
+    with catalog_lock:
+        key = config['datadir'], catalogfile
+        if key not in catalogs:
+            catalogs[key] = Catalog(*key)
+        return catalogs[key]
+
+
+actions = ('plot', 'png', 'svg', 'pdf', 'submit', 'status', 'result', 'list', 'save', 'load', 'newid')
 
 def handle_action(environ, start_response, config):
-    global available_tables
     fields = FieldStorage(fp = environ['wsgi.input'], environ = environ)
     action = fields.getfirst('a')
-    datadir = config['datadir']
     sessiondir = config['sessiondir']
+    environ['ctplot.handler'] = action if action in actions else 'other'
 
-    if action in ['plot', 'png', 'svg', 'pdf']:
+    if action in ['plot', 'png', 'svg', 'pdf', 'submit']:
 
         settings = {}
         for k in fields.keys():
             if k[0] in 'xyzcmsorntwhfgl':
                 settings[k] = fields.getfirst(k).strip().decode('utf8', errors = 'ignore')
 
-        images = make_plot(settings, config)
+        try:
+            if action == 'submit':
+                return serve_json(job_status(submit_plot(settings, config), config), start_response)
+            images = make_plot(settings, config)
+        except ServerBusy as e:
+            start_response('503 Service Unavailable', [content_type(), cc_nocache, ('Retry-After', '10')])
+            return [str(e)]
         for k, v in images.items():
             images[k] = 'plots/' + basename(v)
 
@@ -180,14 +813,21 @@ def handle_action(environ, start_response, config):
             return serve_json(images, start_response)
 
         elif action in ['png', 'svg', 'pdf']:
-            return serve_plot(images[action], start_response, config)
+            return serve_plot(images[action], start_response, config, environ)
+
+
 
+    elif action == 'status':
+        return serve_json(job_status(fields.getfirst('id', '').strip(), config), start_response)
 
+    elif action == 'result':
+        status = job_status(fields.getfirst('id', '').strip(), config)
+        if status['state'] != 'done':  # no result (yet), the status tells why
+            return serve_json(status, start_response, '404 Not Found' if valid_id(status['id']) else '400 Bad Request')
+        return serve_json(status['result'], start_response)
 
     elif action == 'list':
-        if not available_tables or time() - available_tables[0] > 86400:
-            available_tables = time(), ctplot.plot.available_tables(datadir)
-        return serve_json(available_tables[1], start_response)
+        return serve_json(get_catalog(config).tables(cpu_count()), start_response)
 
     elif action == 'save':
         id = fields.getfirst('id').strip()
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import unittest
+import numpy as np
+from ctplot.expressions import Expression
+
+
+class BlockEvaluationTest(unittest.TestCase):
+    'vectorized evaluation must give the results and errors of the row by row evaluation'
+
+    def setUp(self):
+        self.block = {'N':np.array([3, 19, 7], dtype = np.int64),
+                      'Z':np.array([1, 0, 2], dtype = np.int64),
+                      'x':np.array([1.5, -2.0, 4.0])}
+        self.fields = set(self.block)
+
+    def evaluate(self, expr):
+        return list(Expression(expr, self.fields).block(self.block, 3))
+
+    def rows(self, expr):
+        return Expression(expr, self.fields).rows(self.block, 3)
+
+    def test_int64_overflow(self):
+        for expr in ['N**15', 'N*N*N*N*N*N*N*N*N*N*N*N*N*N*N', 'N<<62', 'N**15 + N']:
+            self.assertEqual(self.evaluate(expr), self.rows(expr), expr)
+        self.assertEqual(self.evaluate('N**15')[1], 19 ** 15)
+
+    def test_int64_in_range(self):
+        e = Expression('N*N + N**2', self.fields)
+        self.assertEqual(list(e.block(self.block, 3)), [18, 722, 98])
+        self.assertEqual(e.engines[0][0], 'numpy')
+
+    def test_zero_division(self):
+        for expr in ['x/Z', 'N/Z', 'N//Z', 'N%Z', 'x%Z']:
+            self.assertRaises(ZeroDivisionError, Expression(expr, self.fields).block, self.block, 3)
+
+    def test_fractional_power_of_negative(self):
+        self.assertRaises(ValueError, Expression('x**0.5', self.fields).block, self.block, 3)
+
+    def test_float_division(self):
+        e = Expression('N/x', self.fields)
+        self.assertEqual(list(e.block(self.block, 3)), [2.0, -9.5, 1.75])
+        self.assertEqual(e.engines[0][0], 'numpy')
+
+
+if __name__ == '__main__':
+    unittest.main()